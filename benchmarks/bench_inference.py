@@ -0,0 +1,117 @@
+"""
+Generator inference latency with BatchNorm folding and the TorchScript export, and the output difference.
+
+python benchmarks/bench_inference.py --output_sizes 64,128 --batch_size 16
+python benchmarks/bench_inference.py --output_sizes 64 --bench_epoch 24 --net_dir nets ...   # trained weights
+
+Variants: 'modules' (eval-mode python modules), 'folded' (BatchNorm folded into the convs) and
+'exported' (folded, traced, frozen and optimized, see models/export.py). Without --bench_epoch
+the BatchNorm statistics are randomized, so folding is not trivially exact. Exits with status 1
+if an output differs from 'modules' by more than --tolerance.
+"""
+from __future__ import print_function
+import sys
+import shutil
+import copy
+import json
+import time
+import torch
+
+from bench_utils import get_parser, finish_opts, sync
+from models.inference import KeyPatchGanGenerator
+from models.export import export_generator, example_inputs
+
+
+def randomize_batchnorm(network, generator):
+    for module in network.modules():
+        if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
+            shape = module.running_mean.shape
+            module.running_mean.copy_(torch.randn(shape, generator=generator) * 0.2)
+            module.running_var.copy_(torch.rand(shape, generator=generator) * 1.5 + 0.5)
+            module.weight.data.copy_(torch.rand(shape, generator=generator) + 0.5)
+            module.bias.data.copy_(torch.randn(shape, generator=generator) * 0.2)
+
+
+def measure(opts, fn, inputs):
+    with torch.no_grad():
+        for _ in range(opts.bench_warmup):
+            fn(*inputs)
+        sync(opts)
+        start = time.time()
+        for _ in range(opts.bench_iters):
+            fn(*inputs)
+        sync(opts)
+    return (time.time() - start) / opts.bench_iters
+
+
+def bench_size(opts, output_size):
+    opts = copy.copy(opts)
+    opts.output_size = output_size
+    opts.fold_bn = False
+    opts.embed_cache_mb = 0
+    torch.manual_seed(opts.random_seed)
+    generator = KeyPatchGanGenerator()
+    generator.initialize(opts, epoch=opts.bench_epoch if opts.bench_epoch >= 0 else None)
+    if opts.bench_epoch < 0:
+        rng = torch.Generator()
+        rng.manual_seed(opts.random_seed)
+        for network in [generator.net_part_encoder, generator.net_mask_generator, generator.net_generator]:
+            randomize_batchnorm(network, rng)
+
+    inputs = example_inputs(opts, opts.batch_size, generator.device)
+    variants = [('modules', generator.generate)]
+    with torch.no_grad():
+        reference = generator.generate(*inputs)
+        exported = export_generator(generator, batch_size=opts.batch_size)
+        folded = copy.deepcopy(generator)
+        folded.fold_batchnorm()
+    variants += [('folded', folded.generate), ('exported', exported)]
+
+    results = {}
+    for name, fn in variants:
+        with torch.no_grad():
+            image, mask = fn(*inputs)
+        results[name] = {'sec_per_batch': measure(opts, fn, inputs),
+                         'image_diff': (image - reference[0]).abs().max().item(),
+                         'mask_diff': (mask - reference[1]).abs().max().item()}
+    return results
+
+
+def bench_all(opts):
+    all_results = {}
+    failed = False
+    print('%-8s %-10s %14s %10s %12s %12s' % ('size', 'variant', 'ms/batch', 'speedup', 'image_diff', 'mask_diff'))
+    for output_size in [int(size) for size in opts.output_sizes.split(',')]:
+        results = bench_size(opts, output_size)
+        base = results['modules']['sec_per_batch']
+        for name in ['modules', 'folded', 'exported']:
+            result = results[name]
+            ok = max(result['image_diff'], result['mask_diff']) <= opts.tolerance
+            failed = failed or not ok
+            print('%-8d %-10s %14.2f %9.2fx %12.2e %12.2e%s'
+                  % (output_size, name, result['sec_per_batch'] * 1000, base / result['sec_per_batch'],
+                     result['image_diff'], result['mask_diff'], '' if ok else '  > tolerance'))
+        all_results[str(output_size)] = results
+
+    if opts.bench_out:
+        with open(opts.bench_out, 'w') as f:
+            json.dump(all_results, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument('--output_sizes', default='64,128')
+    parser.add_argument('--bench_epoch', type=int, default=-1)
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    opts = finish_opts(parser.parse_args())
+    opts.precision = 'fp32'
+    try:
+        bench_all(opts)
+    finally:
+        # synthetic images, samples and checkpoints of the run
+        shutil.rmtree(opts.bench_tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+Throughput (images/sec) of the data pipeline and training step stages on synthetic data.
+
+python benchmarks/bench_pipeline.py --batch_size 16 --bench_out results.json
+python benchmarks/bench_pipeline.py ... --save_baseline baseline.json    # store a baseline
+python benchmarks/bench_pipeline.py ... --baseline baseline.json         # exit 1 on regressions
+
+Data stages (get_image, get_part_image, set_mask, prepare_data) run once per output size,
+model stages (set_inputs_for_train, forward, backward_D, backward_G, save_images) for every
+model structure and output size. Only compare results of the same host and options.
+A stage that raises makes the run exit with status 1; stages a configuration does not support
+are skipped and recorded with the reason.
+"""
+from __future__ import print_function
+import os
+import sys
+import shutil
+import copy
+import json
+import time
+import platform
+import numpy as np
+import torch
+from PIL import Image
+
+from bench_utils import get_parser, finish_opts, synthetic_batch, synthetic_bbs, sync
+from models.model import KeyPatchGanModel
+from utils.my_utils import get_image, get_part_image, set_mask, prepare_data
+
+
+DATA_STAGES = ['get_image', 'get_part_image', 'set_mask', 'prepare_data']
+MODEL_STAGES = ['set_inputs_for_train', 'forward', 'backward_D', 'backward_G', 'save_images']
+# DiscriminatorR returns logits, but the GAN loss is BCELoss, which rejects values outside [0, 1]
+UNSUPPORTED_STAGES = {('resblock', 'backward_D'): 'DiscriminatorR has no sigmoid for the BCELoss',
+                      ('resblock', 'backward_G'): 'DiscriminatorR has no sigmoid for the BCELoss'}
+
+
+def measure(opts, num_images, fn, setup=None):
+    # setup (untimed) runs before every call of fn
+    total = 0.0
+    for i in range(opts.bench_warmup + opts.bench_iters):
+        if setup is not None:
+            setup()
+        sync(opts)
+        start = time.time()
+        fn()
+        sync(opts)
+        if i >= opts.bench_warmup:
+            total += time.time() - start
+    return {'images_per_sec': num_images * opts.bench_iters / total,
+            'ms_per_call': 1000.0 * total / opts.bench_iters}
+
+
+def write_images(opts, num_images):
+    # celebA sized jpgs, center cropped to image_size and resized to output_size by get_image
+    rng = np.random.RandomState(0)
+    image_dir = os.path.join(opts.bench_tmp_dir, 'images')
+    os.makedirs(image_dir)
+    image_paths = []
+    for i in range(num_images):
+        image_path = os.path.join(image_dir, '%06d.jpg' % i)
+        Image.fromarray(rng.randint(0, 256, (218, 178, 3)).astype(np.uint8)).save(image_path)
+        image_paths.append(image_path)
+    return image_paths
+
+
+def bench_data(opts, image_paths):
+    bbs = synthetic_bbs(opts, np.random.RandomState(0))
+    images = [get_image(path, opts.image_size, opts.output_size, opts.is_crop, False) for path in image_paths]
+    stages = {}
+
+    def run_get_image():
+        for path in image_paths:
+            get_image(path, opts.image_size, opts.output_size, opts.is_crop, True)
+
+    def run_get_part_image():
+        for i in range(opts.batch_size):
+            for p in range(3):
+                get_part_image(images[i], bbs[i, p], opts.output_size)
+
+    def run_set_mask():
+        for i in range(opts.batch_size):
+            set_mask(bbs[:, 0], bbs[:, 1], bbs[:, 2], i, opts.output_size)
+
+    stages['get_image'] = lambda: measure(opts, opts.batch_size, run_get_image)
+    stages['get_part_image'] = lambda: measure(opts, opts.batch_size, run_get_part_image)
+    stages['set_mask'] = lambda: measure(opts, opts.batch_size, run_set_mask)
+    stages['prepare_data'] = lambda: measure(opts, opts.batch_size,
+                                             lambda: prepare_data(image_paths, bbs, False, opts))
+    return stages
+
+
+def bench_model(opts, model):
+    batch = synthetic_batch(opts, 0)
+    images, shuff_images, part1, part2, part3, z, gt_masks = batch
+    stages = {}
+
+    def set_inputs():
+        model.set_inputs_for_train(images, shuff_images, part1, part2, part3, z, gt_masks, 1e-2, 1e-2)
+
+    def forward():
+        with model.autocast():
+            model.forward()
+
+    def forward_no_grad():
+        with torch.no_grad():
+            forward()
+
+    def setup_backward_D():
+        forward_no_grad()
+        model.optimizer_D.zero_grad()
+
+    def setup_backward_G():
+        forward()
+        model.optimizer_G.zero_grad()
+
+    counter = [0]
+
+    def save_images():
+        counter[0] += 1
+        model.save_images(0, counter[0])
+
+    set_inputs()
+    stages['set_inputs_for_train'] = lambda: measure(opts, opts.batch_size, set_inputs)
+    stages['forward'] = lambda: measure(opts, opts.batch_size, forward)
+    stages['backward_D'] = lambda: measure(opts, opts.batch_size, model.backward_D, setup_backward_D)
+    stages['backward_G'] = lambda: measure(opts, opts.batch_size, model.backward_G, setup_backward_G)
+    stages['save_images'] = lambda: measure(opts, opts.batch_size, save_images, forward_no_grad)
+    for (structure, name), reason in UNSUPPORTED_STAGES.items():
+        if structure == opts.model_structure:
+            stages[name] = lambda reason=reason: {'skipped': reason}
+    return stages
+
+
+def run_stages(results, prefix, stages, names):
+    # returns the keys of the stages that failed; the other stages are still measured
+    failures = []
+    for name in names:
+        key = '%s/%s' % (prefix, name)
+        try:
+            results[key] = stages[name]()
+        except Exception as e:
+            results[key] = {'error': '%s: %s' % (type(e).__name__, e)}
+            failures.append(key)
+            print('%-40s FAILED: %s' % (key, results[key]['error']))
+            continue
+        if 'skipped' in results[key]:
+            print('%-40s skipped: %s' % (key, results[key]['skipped']))
+        else:
+            print('%-40s %12.1f img/s %10.2f ms' % (key, results[key]['images_per_sec'], results[key]['ms_per_call']))
+    return failures
+
+
+def compare(results, baseline, tolerance):
+    # images/sec relative to the baseline; below 1 - tolerance is a regression
+    regressions = []
+    for key in sorted(results.keys()):
+        base = baseline['results'].get(key, {})
+        if 'images_per_sec' not in results[key] or 'images_per_sec' not in base:
+            continue
+        ratio = results[key]['images_per_sec'] / base['images_per_sec']
+        results[key]['baseline_ratio'] = ratio
+        status = 'REGRESSION' if ratio < 1.0 - tolerance else 'ok'
+        if status != 'ok':
+            regressions.append(key)
+        print('%-40s %8.2fx  %s' % (key, ratio, status))
+    return regressions
+
+
+def bench_all(opts):
+    config = dict((k, getattr(opts, k)) for k in ['batch_size', 'conv_dim', 'precision', 'part_interp',
+                                                  'bench_iters'])
+    # the model falls back to CPU without CUDA
+    config.update({'use_gpu': bool(opts.use_gpu and torch.cuda.is_available()),
+                   'host': platform.node(), 'torch': torch.__version__, 'num_threads': torch.get_num_threads()})
+    image_paths = write_images(opts, opts.batch_size)
+
+    results = {}
+    failures = []
+    for output_size in [int(size) for size in opts.output_sizes.split(',')]:
+        size_opts = copy.copy(opts)
+        size_opts.output_size = output_size
+        failures += run_stages(results, 'data_o%d' % output_size, bench_data(size_opts, image_paths), DATA_STAGES)
+
+        for structure in opts.structures.split(','):
+            model_opts = copy.copy(size_opts)
+            model_opts.model_structure = structure
+            torch.manual_seed(opts.random_seed)
+            model = KeyPatchGanModel()
+            model.initialize(model_opts)
+            failures += run_stages(results, '%s_o%d' % (structure, output_size),
+                                   bench_model(model_opts, model), MODEL_STAGES)
+            model.checkpoint_writer.close()
+
+    output = {'config': config, 'results': results}
+    if failures:
+        output['failures'] = failures
+    regressions = []
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        if baseline['config'] != config:
+            print('warning: baseline was measured with a different configuration: %s' % baseline['config'])
+        regressions = compare(results, baseline, opts.tolerance)
+        output['baseline'] = opts.baseline
+        output['regressions'] = regressions
+
+    for path in [opts.bench_out, opts.save_baseline]:
+        if path:
+            with open(path, 'w') as f:
+                json.dump(output, f, indent=2, sort_keys=True)
+
+    if failures:
+        print('%d stages failed: %s' % (len(failures), ', '.join(failures)))
+    if regressions:
+        print('%d regressions: %s' % (len(regressions), ', '.join(regressions)))
+    if failures or regressions:
+        sys.exit(1)
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument('--structures', default='unet,resblock')
+    parser.add_argument('--output_sizes', default='64,128,256')
+    parser.add_argument('--save_baseline', default='')
+    parser.add_argument('--baseline', default='')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    opts = finish_opts(parser.parse_args())
+    try:
+        bench_all(opts)
+    finally:
+        # synthetic images, samples and checkpoints of the run
+        shutil.rmtree(opts.bench_tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Mixed-precision benchmark: train step time and generated samples of --precision modes vs fp32.
+
+All modes start from the same weights and train on the same synthetic batches, so the
+output difference measures both the forward error and the drift after a few updates.
+
+python benchmarks/bench_precision.py --precisions fp32,bf16 --output_size 64 --batch_size 16
+"""
+from __future__ import print_function
+import json
+import shutil
+import time
+import numpy as np
+import torch
+
+from bench_utils import get_parser, finish_opts, synthetic_batch, sync
+from models.model import KeyPatchGanModel
+
+
+def generate(model, batch):
+    images, shuff_images, part1, part2, part3, z, gt_masks = batch
+    model.set_inputs_for_test(images, part1, part2, part3, z)
+    with torch.no_grad(), model.autocast():
+        model.forward()
+    return model.image_gen.float().cpu(), model.gen_mask.float().cpu()
+
+
+def run(opts, precision, eval_batch):
+    opts.precision = precision
+    torch.manual_seed(opts.random_seed)
+    model = KeyPatchGanModel()
+    model.initialize(opts)
+
+    init_image, init_mask = generate(model, eval_batch)
+    step_times = []
+    for i in range(opts.bench_warmup + opts.bench_iters):
+        batch = synthetic_batch(opts, 1 + i)
+        images, shuff_images, part1, part2, part3, z, gt_masks = batch
+        model.set_inputs_for_train(images, shuff_images, part1, part2, part3, z, gt_masks, 1e-2, 1e-2)
+        sync(opts)
+        start = time.time()
+        model.train_step(i)
+        sync(opts)
+        if i >= opts.bench_warmup:
+            step_times.append(time.time() - start)
+    trained_image, trained_mask = generate(model, eval_batch)
+    model.checkpoint_writer.close()
+
+    return {'precision': precision,
+            'step_time_mean': float(np.mean(step_times)),
+            'step_time_median': float(np.median(step_times)),
+            'images_per_sec': opts.batch_size / float(np.median(step_times)),
+            'd_loss': model.pop_losses()['D/loss_all'],
+            'outputs': (init_image, init_mask, trained_image, trained_mask)}
+
+
+def bench_all(opts):
+    eval_batch = synthetic_batch(opts, 0)
+    precisions = opts.precisions.split(',')
+    if 'fp32' not in precisions:
+        precisions = ['fp32'] + precisions
+    results = [run(opts, precision, eval_batch) for precision in precisions]
+
+    reference = results[precisions.index('fp32')]
+    print('%-6s %12s %12s %10s %12s %12s %12s %12s' % ('mode', 'step (ms)', 'img/s', 'speedup',
+                                                        'L1 image', 'L1 mask', 'L1 image*', 'L1 mask*'))
+    for result in results:
+        # mean absolute difference to fp32 at initialization, and (*) after the benchmark steps
+        diffs = [float((a - b).abs().mean()) for a, b in zip(result['outputs'], reference['outputs'])]
+        result['l1_image_init'], result['l1_mask_init'], result['l1_image_trained'], result['l1_mask_trained'] = diffs
+        result['speedup'] = reference['step_time_median'] / result['step_time_median']
+        print('%-6s %12.1f %12.1f %10.2f %12.2e %12.2e %12.2e %12.2e'
+              % (result['precision'], 1000 * result['step_time_median'], result['images_per_sec'],
+                 result['speedup'], diffs[0], diffs[1], diffs[2], diffs[3]))
+
+    for result in results:
+        del result['outputs']
+    if opts.bench_out:
+        config = dict((k, getattr(opts, k)) for k in ['model_structure', 'output_size', 'batch_size', 'conv_dim',
+                                                      'bench_iters', 'use_gpu'])
+        with open(opts.bench_out, 'w') as f:
+            json.dump({'config': config, 'torch': torch.__version__, 'results': results}, f, indent=2)
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument('--precisions', default='fp32,bf16')
+    opts = finish_opts(parser.parse_args())
+    opts.d_steps_per_g = 1
+    try:
+        bench_all(opts)
+    finally:
+        # synthetic images, samples and checkpoints of the run
+        shutil.rmtree(opts.bench_tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import os
+import sys
+import tempfile
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from options.options import Options
+from utils.my_utils import set_masks
+
+
+def get_parser():
+    # the training options plus the common benchmark options
+    parser = Options().parser
+    parser.add_argument('--bench_warmup', type=int, default=2)
+    parser.add_argument('--bench_iters', type=int, default=10)
+    parser.add_argument('--bench_out', default='')
+    return parser
+
+
+def finish_opts(opts):
+    opts.gpu_id = int(opts.gpu_id)
+    opts.use_visdom = False
+    opts.use_tensorboard = False
+    # networks, checkpoints and sample images of the benchmark runs are thrown away
+    tmp_dir = tempfile.mkdtemp(prefix='keypatchgan_bench_')
+    opts.sample_dir = os.path.join(tmp_dir, 'samples')
+    opts.test_dir = os.path.join(tmp_dir, 'test')
+    opts.net_dir = os.path.join(tmp_dir, 'nets')
+    opts.bench_tmp_dir = tmp_dir
+    return opts
+
+
+def synthetic_bbs(opts, rng):
+    # three part boxes (x, y, w, h) per image inside output_size x output_size
+    size = opts.output_size
+    xy = rng.randint(0, size // 2, (opts.batch_size, 3, 2))
+    wh = rng.randint(size // 8, size // 2, (opts.batch_size, 3, 2))
+    return np.concatenate([xy, wh], 2)
+
+
+def synthetic_batch(opts, seed):
+    # uint8 NHWC images/patches, union-of-boxes masks and z, as produced by the data loader
+    rng = np.random.RandomState(seed)
+    size = opts.output_size
+    images = [rng.randint(0, 256, (opts.batch_size, size, size, opts.c_dim)).astype(np.uint8) for _ in range(5)]
+    gt_masks = set_masks(synthetic_bbs(opts, rng), size).numpy()
+    z = torch.from_numpy(rng.uniform(-1, 1, (opts.batch_size, opts.z_dim, 1, 1)).astype(np.float32))
+    return images[0], images[1], images[2], images[3], images[4], z, gt_masks
+
+
+def sync(opts):
+    if opts.use_gpu and torch.cuda.is_available():
+        torch.cuda.synchronize()
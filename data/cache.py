@@ -0,0 +1,157 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+
+from utils.my_utils import get_image, extract_parts, set_mask
+from utils.distributed import barrier
+
+CACHE_VERSION = 2
+CACHE_FIELDS = ['image', 'part1', 'part2', 'part3', 'gt_mask']
+
+
+def cache_paths(opts):
+    name = '%s_i%s_o%s_c%s' % (opts.db_name, opts.image_size, opts.output_size, opts.is_crop)
+    data_path = os.path.join(opts.cache_dir, name + '.u8')
+    index_path = os.path.join(opts.cache_dir, name + '.json')
+    return data_path, index_path
+
+
+def cache_key(dataset, opts):
+    # everything the cached pixels depend on; any change forces a rebuild
+    img_names = '\n'.join([os.path.basename(p) for p in dataset.img_list])
+    bbs = np.ascontiguousarray(dataset.bbs[:len(dataset)])
+    return {'version': CACHE_VERSION,
+            'db_name': str(opts.db_name),
+            'image_size': str(opts.image_size),
+            'output_size': str(opts.output_size),
+            'is_crop': str(opts.is_crop),
+            'part_interp': str(opts.part_interp),
+            'num_imgs': int(len(dataset)),
+            'img_list': hashlib.sha1(img_names.encode('utf-8')).hexdigest(),
+            'bbs': hashlib.sha1(bbs.tobytes()).hexdigest()}
+
+
+def cache_layout(output_size):
+    # one record per image: image, part1, part2, part3 (HxWx3) followed by gt_mask (HxW)
+    layout = []
+    offset = 0
+    for field in CACHE_FIELDS:
+        if field == 'gt_mask':
+            shape = [output_size, output_size]
+        else:
+            shape = [output_size, output_size, 3]
+        layout.append([field, offset, shape])
+        offset += int(np.prod(shape))
+    return layout, offset
+
+
+def build_cache(dataset, opts, data_path, index_path, print_every=1000):
+    output_size = opts.output_size
+    num_imgs = len(dataset)
+    layout, record_size = cache_layout(output_size)
+    offsets = dict((field, offset) for field, offset, _ in layout)
+
+    if not os.path.exists(os.path.dirname(data_path) or '.'):
+        os.makedirs(os.path.dirname(data_path))
+
+    tmp_path = '%s.%d.tmp' % (data_path, os.getpid())
+    records = np.memmap(tmp_path, dtype=np.uint8, mode='w+', shape=(num_imgs, record_size))
+    img_bytes = output_size * output_size * 3
+    for i in range(num_imgs):
+        image = get_image(dataset.img_list[i], opts.image_size, output_size, opts.is_crop, False)
+        bbs = dataset.bbs[i:i+1]
+        records[i, offsets['image']:offsets['image'] + img_bytes] = np.asarray(image).reshape(-1)
+        # key patches as prepare_data extracts them
+        image = torch.from_numpy(np.asarray(image)).permute(2, 0, 1).unsqueeze(0).float()
+        parts = extract_parts(image, bbs, output_size, mode=opts.part_interp)
+        parts = parts.round_().clamp_(0, 255).byte().permute(0, 1, 3, 4, 2).numpy()
+        for j, field in enumerate(['part1', 'part2', 'part3']):
+            records[i, offsets[field]:offsets[field] + img_bytes] = parts[0, j].reshape(-1)
+        mask = set_mask(bbs[:, 0], bbs[:, 1], bbs[:, 2], 0, output_size)
+        records[i, offsets['gt_mask']:] = mask.numpy().astype(np.uint8).reshape(-1)
+        if i % print_every == 0:
+            print('building cache: %06d/%06d' % (i, num_imgs))
+    records.flush()
+    del records
+    os.rename(tmp_path, data_path)
+
+    index = {'key': cache_key(dataset, opts), 'layout': layout, 'record_size': record_size}
+    tmp_path = '%s.%d.tmp' % (index_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.rename(tmp_path, index_path)
+
+
+class DatasetCache():
+    def __init__(self):
+        self.records = None
+        self.pid = None
+
+    def initialize(self, dataset, opts):
+        self.data_path, self.index_path = cache_paths(opts)
+        key = cache_key(dataset, opts)
+        # With --distributed the first process builds the cache while the others wait. If the
+        # cache_dir is local to each node, the first process of every other node builds it next.
+        for builder in [getattr(opts, 'rank', 0) == 0, getattr(opts, 'local_rank', 0) == 0]:
+            if builder and not self.is_valid(key):
+                print('Building dataset cache at %s ...' % self.data_path)
+                build_cache(dataset, opts, self.data_path, self.index_path)
+            barrier(opts)
+        if not self.is_valid(key):
+            raise RuntimeError('Dataset cache %s is missing or out of date' % self.data_path)
+
+        with open(self.index_path) as f:
+            index = json.load(f)
+        self.num_imgs = index['key']['num_imgs']
+        self.record_size = index['record_size']
+        self.layout = dict((field, (offset, tuple(shape))) for field, offset, shape in index['layout'])
+
+    def is_valid(self, key):
+        if not os.path.exists(self.index_path) or not os.path.exists(self.data_path):
+            return False
+        with open(self.index_path) as f:
+            index = json.load(f)
+        if index.get('key') != key:
+            return False
+        return os.path.getsize(self.data_path) == key['num_imgs'] * index['record_size']
+
+    def get_records(self):
+        # memmaps are reopened lazily so that forked/spawned loader workers get their own handle
+        if self.records is None or self.pid != os.getpid():
+            self.records = np.memmap(self.data_path, dtype=np.uint8, mode='r',
+                                     shape=(self.num_imgs, self.record_size))
+            self.pid = os.getpid()
+        return self.records
+
+    def get(self, index, is_flip=False, fields=CACHE_FIELDS):
+        index = np.atleast_1d(index)
+        records = self.get_records()
+        out = []
+        for field in fields:
+            offset, shape = self.layout[field]
+            size = int(np.prod(shape))
+            # only the bytes of this field are read from the rows
+            arr = records[index, offset:offset + size].reshape((len(index),) + shape)
+            if is_flip:
+                arr = arr[:, :, ::-1]
+            out.append(np.ascontiguousarray(arr))
+        return out
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['records'] = None
+        state['pid'] = None
+        return state
+
+
+if __name__ == '__main__':
+    # one-time build step: python -m data.cache --db_name=celebA --dataset_root=... --use_cache=True
+    from options.options import Options
+    from data.database import Dataset
+
+    opts = Options().parse()
+    opts.use_cache = True
+    dataset = Dataset()
+    dataset.initialize(opts)
@@ -4,7 +4,8 @@ import torch
 from PIL import Image
 import numpy as np
 from glob import glob
-import scipy.io
+
+from .cache import DatasetCache
 
 class Dataset():
     def __init__(self):
@@ -18,6 +19,7 @@ class Dataset():
         self.db_name = opts.db_name
         self.edgeBoxResol = opts.edge_box_resol
         self.output_size = opts.output_size
+        import scipy.io
 
         if self.db_name == 'celebA':
             # Load image list
@@ -29,7 +31,7 @@ class Dataset():
             # Load part BBoxes
             bbs = scipy.io.loadmat("celebA_allbbs.mat")['allbbs']
             changeRatio = float(self.output_size) / 128.0
-            bbs = np.floor(bbs * changeRatio).astype(np.int)
+            bbs = np.floor(bbs * changeRatio).astype(int)
 
             self.bbs = bbs
 
@@ -43,18 +45,30 @@ class Dataset():
             # Load part BBoxes
             bbs = scipy.io.loadmat("compcar_allbbs.mat")['allbbs']
             changeRatio = opts.output_size
-            bbs = np.floor(bbs * changeRatio).astype(np.int)
+            bbs = np.floor(bbs * changeRatio).astype(int)
 
             self.bbs = bbs
 
         else:
             print ('Not ready for this dataset ...')
 
+        self.cache = None
+        if opts.use_cache:
+            self.cache = DatasetCache()
+            self.cache.initialize(self, opts)
+
     def __getitem__(self, index):
         img_path = self.img_list[index]
         bbs = self.bbs[index]
         return img_path, bbs
 
+    def get_batch(self, index, is_flip=False):
+        # cropped images, key patches and gt masks as uint8 arrays, sliced from the cache
+        return self.cache.get(index, is_flip)
+
+    def get_images(self, index, is_flip=False):
+        return self.cache.get(index, is_flip, fields=['image'])[0]
+
     def __len__(self):
         # return len(self.paths)
         return self.num_imgs
@@ -0,0 +1,133 @@
+import random
+import numpy as np
+import torch
+import torch.utils.data
+
+from .sampler import ShuffledNegativeSampler
+from utils.my_utils import prepare_data, get_image, to_batch_tensor
+from utils.profiler import Profiler
+
+
+def make_epoch_plan(train_idx, batch_size, shuff_sampling='replace'):
+    # batch / shuffled-negative indices and flips of one epoch, drawn from the global numpy RNG
+    num_train_imgs = len(train_idx)
+    curr_epoch_idx = np.random.permutation(num_train_imgs)
+    curr_train_idx = train_idx[curr_epoch_idx]
+    num_batches = num_train_imgs // batch_size
+
+    sampler = ShuffledNegativeSampler()
+    sampler.initialize(num_train_imgs, batch_size, mode=shuff_sampling)
+    sampler.set_epoch()
+
+    batch_idx = np.zeros((num_batches, batch_size), dtype=np.int64)
+    shuff_idx = np.zeros((num_batches, batch_size), dtype=np.int64)
+    flips = np.zeros(num_batches, dtype=bool)
+    for i in range(num_batches):
+        batch_idx_offset = i * batch_size
+        batch_idx[i] = curr_train_idx[batch_idx_offset:batch_idx_offset+batch_size]
+        shuff_idx[i] = curr_train_idx[sampler.sample(batch_idx_offset)]
+        flips[i] = np.random.rand() > 0.5
+
+    return {'batch_idx': batch_idx, 'shuff_idx': shuff_idx, 'flips': flips}
+
+
+def shard_plan(plan, rank, world_size):
+    # batches rank, rank + world_size, ... of an epoch plan; every rank gets the same number
+    num_batches = len(plan['batch_idx']) // world_size
+    batch_ids = np.arange(rank, num_batches * world_size, world_size)
+    shard = dict((k, v[batch_ids]) for k, v in plan.items())
+    shard['batch_ids'] = batch_ids
+    return shard
+
+
+def make_seed(random_seed, epoch, *keys):
+    return int(np.random.SeedSequence([int(random_seed), epoch] + list(keys)).generate_state(1)[0])
+
+
+class TrainBatches(torch.utils.data.Dataset):
+    # one item is one full training batch of the current epoch plan
+    def __init__(self, dataset, opts, profiler=None):
+        self.dataset = dataset
+        self.opts = opts
+        self.epoch = 0
+        self.plan = None
+        self.profiler = profiler or Profiler()
+
+    def set_plan(self, epoch, plan):
+        self.epoch = epoch
+        self.plan = plan
+
+    def __len__(self):
+        return len(self.plan['batch_idx'])
+
+    def __getitem__(self, i):
+        opts = self.opts
+        batch_train_idx = self.plan['batch_idx'][i]
+        batch_shuff_idx = self.plan['shuff_idx'][i]
+        is_flip = bool(self.plan['flips'][i])
+
+        if opts.use_cache:
+            with self.profiler.stage('read_cache'):
+                images, part1, part2, part3, gt_masks = self.dataset.get_batch(batch_train_idx, is_flip)
+                shuff_images = self.dataset.get_images(batch_shuff_idx, is_flip)
+        else:
+            train_image_paths, train_bbs = self.dataset[batch_train_idx]
+            shuff_image_paths, _         = self.dataset[batch_shuff_idx]
+            train_bbs = train_bbs.copy()
+            if is_flip:
+                train_bbs[:, :, 0] = opts.output_size - (train_bbs[:, :, 0] + train_bbs[:, :, 2])
+            with self.profiler.stage('prepare_data'):
+                images, part1, part2, part3, gt_masks, _ = prepare_data(train_image_paths, train_bbs, is_flip, opts)
+            with self.profiler.stage('get_image_shuff'):
+                shuff_images = [get_image(shuff_image_paths[j], opts.image_size, opts.output_size, opts.is_crop,
+                                          is_flip) for j in range(opts.batch_size)]
+
+        # z depends only on (seed, epoch, batch), not on which worker or rank built the batch
+        batch_id = int(self.plan['batch_ids'][i]) if 'batch_ids' in self.plan else i
+        generator = torch.Generator()
+        generator.manual_seed(make_seed(opts.random_seed, self.epoch, 0, batch_id))
+        z = torch.rand([opts.batch_size, opts.z_dim, 1, 1], generator=generator) * 2.0 - 1.0
+
+        # uint8 NHWC batches, normalized on the training device by set_inputs_for_train
+        return to_batch_tensor(images), to_batch_tensor(shuff_images), \
+            to_batch_tensor(part1), to_batch_tensor(part2), to_batch_tensor(part3), \
+            to_batch_tensor(gt_masks), z
+
+
+class BatchLoader():
+    def __init__(self):
+        self.opts = []
+
+    def initialize(self, dataset, opts, profiler=None, layout=None):
+        self.opts = opts
+        self.layout = layout
+        self.num_workers = opts.num_workers
+        self.batches = TrainBatches(dataset, opts, profiler)
+        self.pin_memory = bool(opts.use_gpu) and torch.cuda.is_available()
+
+    def worker_init_fn(self, worker_id):
+        seed = make_seed(self.opts.random_seed, self.batches.epoch, 1, worker_id)
+        np.random.seed(seed)
+        random.seed(seed)
+        torch.manual_seed(seed)
+        if self.layout is not None:
+            self.layout.pin_worker(worker_id)
+        self.batches.profiler.on_fork()
+
+    def epoch_batches(self, epoch, plan, start=0):
+        # batch k+1.. are built by the workers while batch k trains; start skips finished batches
+        self.batches.set_plan(epoch, plan)
+        generator = torch.Generator()
+        generator.manual_seed(make_seed(self.opts.random_seed, epoch, 2))
+        kwargs = {}
+        if self.num_workers > 0:
+            kwargs['prefetch_factor'] = self.opts.prefetch_batches
+            kwargs['worker_init_fn'] = self.worker_init_fn
+        loader = torch.utils.data.DataLoader(self.batches, batch_size=None,
+                                             sampler=range(start, len(self.batches)),
+                                             num_workers=self.num_workers, pin_memory=self.pin_memory,
+                                             generator=generator, **kwargs)
+        return iter(loader)
+
+    def name(self):
+        return 'BatchLoader'
@@ -0,0 +1,38 @@
+import numpy as np
+
+
+class ShuffledNegativeSampler():
+    # Draws the mismatched ("shuffled") images used by backward_D from outside the current batch.
+    # Positions refer to the epoch permutation, the batch occupies [offset, offset + batch_size).
+    #   replace: uniform over the other positions with replacement (same distribution as
+    #            np.random.choice over np.setdiff1d), in O(batch_size)
+    #   unique:  the batch shifted by a random per-epoch offset, so no image is used as a
+    #            negative twice within an epoch (needs at least 2 * batch_size images)
+    def __init__(self):
+        self.mode = 'replace'
+
+    def initialize(self, num_items, batch_size, mode='replace', rng=np.random):
+        if mode not in ['replace', 'unique']:
+            raise ValueError('Unknown shuffled sampling mode: %s' % mode)
+        if mode == 'unique' and num_items < 2 * batch_size:
+            raise ValueError('unique shuffled sampling needs at least %d images' % (2 * batch_size))
+        self.num_items = num_items
+        self.batch_size = batch_size
+        self.mode = mode
+        self.rng = rng
+        self.shift = 0
+
+    def set_epoch(self):
+        if self.mode == 'unique':
+            self.shift = self.rng.randint(self.batch_size, self.num_items - self.batch_size + 1)
+
+    def sample(self, batch_idx_offset):
+        if self.mode == 'unique':
+            return (batch_idx_offset + self.shift + np.arange(self.batch_size)) % self.num_items
+
+        pos = self.rng.randint(0, self.num_items - self.batch_size, size=self.batch_size)
+        pos[pos >= batch_idx_offset] += self.batch_size
+        return pos
+
+    def name(self):
+        return 'ShuffledNegativeSampler'
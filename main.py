@@ -1,61 +1,97 @@
-import numpy as np
-import torch
-from torch.autograd import Variable
-import torchvision.transforms as transforms
-from glob import glob
-import scipy.io
+from utils.startup import startup_timer
 import os
+import sys
 import time
 
-from data.database import *
-from utils.my_utils import *
-from options.options import *
-from models.model import KeyPatchGanModel
-
 ###############################################################
 # Get Options
 ###############################################################
+with startup_timer.stage('import options'):
+    from options.options import *
 opts = Options().parse()
 
+# heavy imports, timed for --profile_startup
+with startup_timer.stage('import numpy'):
+    import numpy as np
+with startup_timer.stage('import torch'):
+    import torch
+
+# --distributed: this process starts the training processes of the node and waits for them
+from utils.distributed import launch, init_distributed, cleanup_distributed
+if launch(opts):
+    sys.exit(0)
+init_distributed(opts)
+
+# --cpu_layout: cores of this process (split between processes on the node), inter-op threads
+from utils.resources import ResourceLayout
+layout = ResourceLayout()
+layout.initialize(opts)
+
+with startup_timer.stage('import data'):
+    from data.database import *
+    from data.loader import BatchLoader, make_epoch_plan, shard_plan
+    from utils.my_utils import *
+with startup_timer.stage('import model'):
+    from models.model import KeyPatchGanModel
+    from utils.checkpoint import get_rng_state, set_rng_state
+
 
 ###############################################################
 # Initialize Database
 ###############################################################
-dataset = Dataset()
-dataset.initialize(opts)
+with startup_timer.stage('init dataset'):
+    dataset = Dataset()
+    dataset.initialize(opts)
 
 
 # Split train/test data
 np.random.seed(opts.random_seed)
+torch.manual_seed(opts.random_seed)
 all_idx = np.random.permutation(len(dataset))
 test_idx = all_idx[-opts.num_tests:]
 sample_idx = all_idx[:opts.num_samples]
 train_idx = all_idx[:-opts.num_tests]
 num_train_imgs = len(train_idx)
 
+# pin the training threads and loader workers before the model is built
+if opts.cpu_layout == 'autotune':
+    with startup_timer.stage('autotune cpu layout'):
+        layout.autotune(dataset, train_idx)
+layout.apply()
+
 ###############################################################
 # Initialize Model
 ###############################################################
-model = KeyPatchGanModel()
-model.initialize(opts)
+with startup_timer.stage('init model'):
+    model = KeyPatchGanModel()
+    model.initialize(opts)
 
 ###############################################################
 # Start Training
 ###############################################################
 
-''' Preparing Test Data '''
-# set test images
-test_img_paths, test_bbs = dataset[test_idx]
-is_flip = False
-test_images, test_part1_images, test_part2_images, test_part3_images, test_gt_masks, test_z = \
-    prepare_data(test_img_paths, test_bbs, is_flip, opts)
-
-''' Preparing Sample Data '''
-# set sample images
-sample_img_paths, sample_bbs = dataset[sample_idx]
-is_flip = False
-sample_images, sample_part1_images, sample_part2_images, sample_part3_images, sample_gt_masks, sample_z = \
-    prepare_data(sample_img_paths, sample_bbs, is_flip, opts)
+with startup_timer.stage('prepare test/sample data'):
+    ''' Preparing Test Data '''
+    # set test images
+    is_flip = False
+    if opts.use_cache:
+        test_images, test_part1_images, test_part2_images, test_part3_images, test_gt_masks, test_z = \
+            prepare_data_cached(dataset, test_idx, is_flip, opts)
+    else:
+        test_img_paths, test_bbs = dataset[test_idx]
+        test_images, test_part1_images, test_part2_images, test_part3_images, test_gt_masks, test_z = \
+            prepare_data(test_img_paths, test_bbs, is_flip, opts)
+
+    ''' Preparing Sample Data '''
+    # set sample images
+    is_flip = False
+    if opts.use_cache:
+        sample_images, sample_part1_images, sample_part2_images, sample_part3_images, sample_gt_masks, sample_z = \
+            prepare_data_cached(dataset, sample_idx, is_flip, opts)
+    else:
+        sample_img_paths, sample_bbs = dataset[sample_idx]
+        sample_images, sample_part1_images, sample_part2_images, sample_part3_images, sample_gt_masks, sample_z = \
+            prepare_data(sample_img_paths, sample_bbs, is_flip, opts)
 
 
 ''' Main Training Loop Here '''
@@ -66,89 +102,123 @@ m_weight_appr = np.logspace(-2, -4, num=opts.epoch)
 # m_weight_appr = np.logspace(0, 0, num=opts.epoch)
 
 
+profiler = model.profiler
+loader = BatchLoader()
+loader.initialize(dataset, opts, profiler, layout)
+
+# resume: epoch plan, RNG state, loss-weight schedule and in-epoch cursor of the checkpoint
+start_epoch = 0
+start_iter = 0
+resume_state = model.resume_state
+if resume_state is not None:
+    start_epoch = resume_state['epoch']
+    start_iter = resume_state['iteration']
+    if 'np_rng_keys' in resume_state:
+        set_rng_state(resume_state)
+    if 'm_weight_mask' in resume_state:
+        m_weight_mask = resume_state['m_weight_mask'].numpy()
+        m_weight_appr = resume_state['m_weight_appr'].numpy()
+
+def get_train_state(plan=None):
+    train_state = get_rng_state()
+    train_state['m_weight_mask'] = torch.from_numpy(m_weight_mask)
+    train_state['m_weight_appr'] = torch.from_numpy(m_weight_appr)
+    if plan is not None:
+        train_state['plan'] = dict((k, torch.from_numpy(v)) for k, v in plan.items())
+    return train_state
+
 start_time = time.time()
-for epoch in range(opts.epoch):
+for epoch in range(start_epoch, opts.epoch):
     # shuffle data
-    curr_epoch_idx = np.random.permutation(num_train_imgs)
-    curr_train_idx = train_idx[curr_epoch_idx]
-    num_batches = num_train_imgs // opts.batch_size
-
-    for i in range(num_batches):
-        batch_idx_offset = i * opts.batch_size
-        batch_train_idx = curr_train_idx[batch_idx_offset:batch_idx_offset+opts.batch_size]
-        batch_train_other_idx = curr_train_idx[np.setdiff1d(np.arange(len(curr_train_idx)),
-                                       np.arange(batch_idx_offset, batch_idx_offset+opts.batch_size))]
-        batch_shuff_idx = np.random.choice(batch_train_other_idx, size=opts.batch_size)
-
-        train_image_paths, train_bbs = dataset[batch_train_idx]
-        shuff_image_paths, _         = dataset[batch_shuff_idx]
-
-        if np.random.rand() > 0.5:
-            is_flip = True
-            train_bbs[:, :, 0] = opts.output_size - (train_bbs[:, :, 0] + train_bbs[:, :, 2])
-        else:
-            is_flip = False
-
-        # load images
-        train_images, train_part1_images, train_part2_images, train_part3_images, train_gt_masks, train_z = \
-            prepare_data(train_image_paths, train_bbs, is_flip, opts)
-        train_shuff_images = [get_image(shuff_image_paths[j], opts.image_size, opts.output_size, opts.is_crop, is_flip) for
-                        j in range(opts.batch_size)]
+    if epoch == start_epoch and resume_state is not None and 'plan' in resume_state:
+        plan = dict((k, v.numpy()) for k, v in resume_state['plan'].items())
+    else:
+        plan = make_epoch_plan(train_idx, opts.batch_size, opts.shuff_sampling)
+        start_iter = 0
+    # every process trains on its own share of the batches; the checkpoint keeps the full plan
+    rank_plan = shard_plan(plan, opts.rank, opts.world_size) if opts.distributed else plan
+    num_batches = len(rank_plan['batch_idx'])
+
+    batches = profiler.iterate(loader.epoch_batches(epoch, rank_plan, start_iter), 'loader_wait')
+    for i, batch in enumerate(batches, start_iter):
+        # load images (built by the loader workers)
+        train_images, train_shuff_images, train_part1_images, train_part2_images, train_part3_images, \
+            train_gt_masks, train_z = batch
 
         # Set input images
-        model.set_inputs_for_train(train_images, train_shuff_images,
-                                   train_part1_images, train_part2_images, train_part3_images,
-                                   train_z, train_gt_masks, m_weight_mask[epoch],m_weight_appr[epoch])
+        with profiler.stage('set_inputs'):
+            model.set_inputs_for_train(train_images, train_shuff_images,
+                                       train_part1_images, train_part2_images, train_part3_images,
+                                       train_z, train_gt_masks, m_weight_mask[epoch],m_weight_appr[epoch])
 
 
-        model.loss = {}
-
-        # Train D
-        model.forward()
-        model.optimize_parameters_D()
-
-        # Train G
-        if i % 2 == 1:
-            model.forward()
-            model.optimize_parameters_G()
+        # Train D, and G every opts.d_steps_per_g iterations
+        with profiler.stage('train_step'):
+            model.train_step(i)
+        if i == start_iter:
+            startup_timer.mark('first train step')
 
         if (i % 10 == 1):
-            print('epoch: %02d/%02d, iter: %04d/%04d, d_loss: %f. g_loss_gan: %f, g_loss_appr: %f, g_loss_mask: %f, %f sec'
-                  % (epoch+1, opts.epoch, i, num_batches, model.d_loss.cpu().data.numpy(),
-                     model.g_loss_gan.cpu().data.numpy(),
-                     model.g_loss_l1_appr.cpu().data.numpy(),
-                     model.g_loss_l1_mask.cpu().data.numpy(),
-                     time.time()-start_time))
-            if opts.use_tensorboard:
-                for tag, value in model.loss.items():
+            # losses are averaged on the device since the last print and copied to the host here
+            loss = model.pop_losses()
+            if model.is_main:
+                print('epoch: %02d/%02d, iter: %04d/%04d, d_loss: %f. g_loss_gan: %f, g_loss_appr: %f, g_loss_mask: %f, %f sec'
+                      % (epoch+1, opts.epoch, i, num_batches, loss.get('D/loss_all', np.nan),
+                         loss.get('G/loss_fake', np.nan),
+                         loss.get('G/loss_appr', np.nan),
+                         loss.get('G/loss_mask', np.nan),
+                         time.time()-start_time))
+            if opts.use_tensorboard and model.is_main:
+                for tag, value in loss.items():
                     model.logger.scalar_summary(tag, value, epoch * num_batches + i)
+                profiler.log_scalars(model.logger, epoch * num_batches + i)
 
 
         if (i % 200 == 1):
+            # the forwards run on every process (sync batch norm), only the main process shows/saves
             if opts.use_visdom:
+                with profiler.stage('visualize'), torch.no_grad():
+                    model.set_inputs_for_train(sample_images, sample_images,
+                                               sample_part1_images, sample_part2_images, sample_part3_images,
+                                               sample_z, sample_gt_masks, m_weight_mask[epoch],m_weight_appr[epoch])
+                    model.forward()
+                    model.visualize(win_offset=0)
+                    model.set_inputs_for_train(test_images, test_images,
+                                               test_part1_images, test_part2_images, test_part3_images,
+                                               test_z, test_gt_masks, m_weight_mask[epoch],m_weight_appr[epoch])
+                    model.forward()
+                    model.visualize(win_offset=100)
+
+            with profiler.stage('save_images'), torch.no_grad():
                 model.set_inputs_for_train(sample_images, sample_images,
                                            sample_part1_images, sample_part2_images, sample_part3_images,
                                            sample_z, sample_gt_masks, m_weight_mask[epoch],m_weight_appr[epoch])
                 model.forward()
-                model.visualize(win_offset=0)
+                model.save_images(epoch, i, is_test=False)
                 model.set_inputs_for_train(test_images, test_images,
                                            test_part1_images, test_part2_images, test_part3_images,
                                            test_z, test_gt_masks, m_weight_mask[epoch],m_weight_appr[epoch])
                 model.forward()
-                model.visualize(win_offset=100)
-
-            model.set_inputs_for_train(sample_images, sample_images,
-                                       sample_part1_images, sample_part2_images, sample_part3_images,
-                                       sample_z, sample_gt_masks, m_weight_mask[epoch],m_weight_appr[epoch])
-            model.forward()
-            model.save_images(epoch, i, is_test=False)
-            model.set_inputs_for_train(test_images, test_images,
-                                       test_part1_images, test_part2_images, test_part3_images,
-                                       test_z, test_gt_masks, m_weight_mask[epoch],m_weight_appr[epoch])
-            model.forward()
-            model.save_images(epoch, i, is_test=True)
-
-    model.save(epoch)
+                model.save_images(epoch, i, is_test=True)
+
+        if opts.profile_startup and (i % 200 == 1):
+            # after the first logging/visualization, so lazily created integrations are included
+            startup_timer.report()
+
+        if opts.save_every > 0 and (i + 1) % opts.save_every == 0:
+            with profiler.stage('save_checkpoint'):
+                model.save_checkpoint(epoch, i + 1, get_train_state(plan))
+
+    with profiler.stage('save_checkpoint'):
+        model.save(epoch, get_train_state())
+    profiler.print_summary()
+
+if opts.profile_startup:
+    startup_timer.report()
+
+# wait for pending checkpoint writes, flush the logs
+model.close()
+cleanup_distributed(opts)
 
 
 
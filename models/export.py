@@ -0,0 +1,156 @@
+"""
+Export of the U-Net generator stack as a single frozen TorchScript graph for deployment:
+
+python -m models.export --db_name=celebA --output_size=64 --export_epoch=24 --export_path=generator.pt
+
+The file only needs torch to run:
+    pipeline = torch.jit.optimize_for_inference(torch.jit.load('generator.pt'))
+    image, mask = pipeline(part1, part2, part3, z)   # uint8 (N, S, S, C) key patches, z (N, z_dim, 1, 1)
+"""
+import copy
+import json
+import time
+import torch
+import torch.nn as nn
+
+from .networks import fold_batchnorm
+
+
+def set_output_padding(decoder):
+    # The U-Net decoders pass output_size=[4, 8, 16, ...] to their transposed convs; the same
+    # sizes as a fixed output_padding of every layer (the first one maps the 1x1 embedding to 4x4).
+    size = 1
+    for i in range(0, len(decoder), 2):
+        convT = decoder[i]
+        target = 4 * 2 ** (i // 2)
+        default = (size - 1) * convT.stride[0] - 2 * convT.padding[0] + \
+            convT.dilation[0] * (convT.kernel_size[0] - 1) + 1
+        convT.output_padding = (target - default, target - default)
+        size = target
+    return decoder
+
+
+def run_decoder(decoder, out, skips):
+    # (convT, activation) blocks; skips[k] is concatenated to the output of block k except the last
+    outputs = []
+    num_blocks = len(decoder) // 2
+    for k in range(num_blocks):
+        out = decoder[2 * k + 1](decoder[2 * k](out))
+        if k < num_blocks - 1:
+            out = torch.cat([out, skips[k]], 1)
+        outputs.append(out)
+    return outputs
+
+
+class PatchInput(nn.Module):
+    # uint8 NHWC key patches -> one (3N, C, S, S) batch in [-1, 1]
+    def forward(self, part1, part2, part3):
+        out = torch.cat([part1, part2, part3], 0).permute(0, 3, 1, 2).float()
+        return out.mul(1.0 / 127.5).sub(1.0)
+
+
+class GeneratorPipeline(nn.Module):
+    # Key patches and z -> (image, mask) with the U-Net part encoder, mask generator and image
+    # generator: the computation of KeyPatchGanGenerator.generate without the embedding cache.
+    # Inputs are uint8 NHWC key patches, the image is in [-1, 1] and the mask in [0, 1].
+    def __init__(self, part_encoder, mask_generator, image_generator):
+        super(GeneratorPipeline, self).__init__()
+        self.patch_input = PatchInput()
+        self.part_encoder = copy.deepcopy(part_encoder.model)
+        self.mask_generator = set_output_padding(copy.deepcopy(mask_generator.model))
+        self.image_generator = set_output_padding(copy.deepcopy(image_generator.model))
+        # freezing folds Conv2d+BatchNorm only, the decoders need the transposed conv folding
+        for network in [self.part_encoder, self.mask_generator, self.image_generator]:
+            fold_batchnorm(network)
+
+    def forward(self, part1, part2, part3, z):
+        out = self.patch_input(part1, part2, part3)
+
+        # encoder outputs of all levels, summed over the three parts
+        parts_enc = []
+        for layer in self.part_encoder:
+            out = layer(out)
+            enc = out.chunk(3, 0)
+            parts_enc.append(enc[0] + enc[1] + enc[2])
+
+        masks = run_decoder(self.mask_generator, parts_enc[-1], parts_enc[-2::-1])
+        images = run_decoder(self.image_generator, torch.cat([parts_enc[-1], z], 1), masks)
+        return images[-1], masks[-1]
+
+
+def example_inputs(opts, batch_size, device):
+    shape = (batch_size, opts.output_size, opts.output_size, opts.c_dim)
+    parts = [torch.randint(0, 256, shape, dtype=torch.uint8, device=device) for _ in range(3)]
+    z = torch.rand([batch_size, opts.z_dim, 1, 1], device=device) * 2.0 - 1.0
+    return parts[0], parts[1], parts[2], z
+
+
+def export_generator(generator, path=None, batch_size=4, optimize=True):
+    """Trace and freeze the generator stack of a KeyPatchGanGenerator; the graph accepts any batch size.
+
+    BatchNorm is folded into the convs, freezing inlines the weights and constant-folds the layer sizes.
+    The frozen graph is saved to path (with the options needed to call it) when given. optimize_for_inference,
+    which fuses conv+activation for the device, is applied to the returned graph only: its MKLDNN
+    constants cannot be serialized, so it is run again after torch.jit.load.
+    """
+    opts = generator.opts
+    pipeline = GeneratorPipeline(generator.net_part_encoder, generator.net_mask_generator,
+                                 generator.net_generator).to(generator.device).eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(pipeline, example_inputs(opts, batch_size, generator.device))
+    exported = torch.jit.freeze(traced)
+
+    if path is not None:
+        metadata = {'output_size': opts.output_size, 'c_dim': opts.c_dim, 'z_dim': opts.z_dim,
+                    'inputs': 'part1, part2, part3: uint8 (N, S, S, C); z: float32 (N, z_dim, 1, 1) in [-1, 1]',
+                    'outputs': 'image: (N, C, S, S) in [-1, 1]; mask: (N, 1, S, S) in [0, 1]'}
+        torch.jit.save(exported, path, _extra_files={'keypatchgan.json': json.dumps(metadata)})
+    if optimize:
+        exported = torch.jit.optimize_for_inference(exported)
+    return exported
+
+
+def time_call(function, inputs, iters):
+    with torch.no_grad():
+        function(*inputs)
+        start = time.time()
+        for _ in range(iters):
+            function(*inputs)
+    return (time.time() - start) / iters
+
+
+if __name__ == '__main__':
+    from options.options import Options, str2bool
+    from models.inference import KeyPatchGanGenerator
+
+    parser = Options().parser
+    parser.add_argument('--export_epoch', type=int, required=True)
+    parser.add_argument('--export_path', default='keypatchgan_generator.pt')
+    parser.add_argument('--export_batch_size', type=int, default=4)
+    parser.add_argument('--export_optimize', type=str2bool, default=True)
+    parser.add_argument('--export_check_iters', type=int, default=10)
+    opts = parser.parse_args()
+    opts.gpu_id = int(opts.gpu_id)
+    opts.precision = 'fp32'
+    opts.embed_cache_mb = 0
+
+    generator = KeyPatchGanGenerator()
+    generator.initialize(opts, epoch=opts.export_epoch)
+    export_generator(generator, opts.export_path, opts.export_batch_size, opts.export_optimize)
+    print('Exported to %s' % opts.export_path)
+
+    # check the saved graph against the python modules, at a batch size other than the traced one
+    start = time.time()
+    exported = torch.jit.load(opts.export_path, map_location=generator.device)
+    if opts.export_optimize:
+        exported = torch.jit.optimize_for_inference(exported)
+    load_sec = time.time() - start
+    inputs = example_inputs(opts, opts.export_batch_size + 1, generator.device)
+    with torch.no_grad():
+        image, mask = exported(*inputs)
+    ref_image, ref_mask = generator.generate(*inputs)
+    print('max abs difference: image %.2e, mask %.2e' % ((image - ref_image).abs().max().item(),
+                                                         (mask - ref_mask).abs().max().item()))
+    print('load %.3f sec; per batch of %d: modules %.4f sec, exported %.4f sec'
+          % (load_sec, inputs[0].shape[0], time_call(generator.generate, inputs, opts.export_check_iters),
+             time_call(exported, inputs, opts.export_check_iters)))
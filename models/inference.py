@@ -0,0 +1,292 @@
+import os
+import hashlib
+from collections import OrderedDict
+import torch
+
+from .networks import PartEncoderU, MaskGeneratorU, ImageGeneratorU, get_num_conv_layers, keep_norm_fp32, \
+    fold_batchnorm
+from utils.my_utils import to_batch_tensor
+from utils.checkpoint import network_name, save_dir_name
+
+
+def tensors_nbytes(tensors):
+    return sum([t.numel() * t.element_size() for t in tensors])
+
+
+def patch_key(patch):
+    # content address of one key patch (any dtype/layout the generator accepts)
+    patch = patch.detach().cpu().contiguous()
+    digest = hashlib.sha1(patch.numpy().tobytes()).hexdigest()
+    return '%s%s:%s' % (str(patch.dtype), tuple(patch.shape), digest)
+
+
+class PartEmbeddingCache():
+    # LRU cache of lists of tensors, evicting the least recently used entries beyond max_bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.pop(key)
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        size = tensors_nbytes(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.num_bytes -= tensors_nbytes(self.entries.pop(key))
+        self.entries[key] = value
+        self.num_bytes += size
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= tensors_nbytes(evicted)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+
+class KeyPatchGanGenerator():
+    # Inference-only key-patches -> (image, mask) generation with the U-Net generator stack.
+    # Loads only the part encoder, mask generator and image generator; no D, no optimizers.
+    def __init__(self):
+        self.opts = []
+
+    def initialize(self, opts, epoch, net_save_dir=None):
+        if opts.model_structure != 'unet':
+            raise ValueError('KeyPatchGanGenerator supports the unet model structure only')
+        self.opts = opts
+        self.c_dim = opts.c_dim
+        self.z_dim = opts.z_dim
+        self.output_size = opts.output_size
+        self.max_batch_size = opts.infer_batch_size
+        self.max_sample_bytes = int(opts.infer_memory_mb * 1024 * 1024)
+        self.sample_bytes = None
+        if opts.use_gpu and torch.cuda.is_available():
+            self.device = torch.device('cuda', opts.gpu_id)
+        else:
+            self.device = torch.device('cpu')
+        self.amp_dtype = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[opts.precision]
+
+        if net_save_dir is None:
+            net_save_dir = os.path.join(opts.net_dir, opts.db_name, save_dir_name(opts))
+        self.net_save_dir = net_save_dir
+
+        self.opts.num_conv_layers = get_num_conv_layers(opts.output_size)
+        self.net_part_encoder = PartEncoderU(self.opts)
+        self.net_mask_generator = MaskGeneratorU(self.opts)
+        self.net_generator = ImageGeneratorU(self.opts)
+        if epoch is not None:
+            self.load_network(self.net_part_encoder, epoch, 'net_partenc')
+            self.load_network(self.net_mask_generator, epoch, 'net_maskgen')
+            self.load_network(self.net_generator, epoch, 'net_imggen')
+
+        for network in [self.net_part_encoder, self.net_mask_generator, self.net_generator]:
+            network.to(self.device)
+            network.eval()
+            for param in network.parameters():
+                param.requires_grad = False
+            if self.amp_dtype is not None:
+                keep_norm_fp32(network)
+
+        # per-patch encoder outputs (all levels) and per-triple (parts_enc, mask pyramid),
+        # valid because eval-mode networks treat every sample independently
+        self.patch_cache = None
+        self.triple_cache = None
+        if opts.embed_cache_mb > 0:
+            max_bytes = int(opts.embed_cache_mb * 1024 * 1024)
+            self.patch_cache = PartEmbeddingCache(max_bytes // 2)
+            self.triple_cache = PartEmbeddingCache(max_bytes // 2)
+
+        if opts.fold_bn:
+            self.fold_batchnorm()
+
+    def fold_batchnorm(self):
+        # eval-mode BatchNorm folded into the convs: same outputs up to float rounding, less work
+        for network in [self.net_part_encoder, self.net_mask_generator, self.net_generator]:
+            fold_batchnorm(network)
+        if self.patch_cache is not None:
+            self.patch_cache.clear()
+            self.triple_cache.clear()
+
+    def load_network(self, network, epoch, net_name):
+        save_path = os.path.join(self.net_save_dir, network_name(epoch, net_name))
+        network.load_state_dict(torch.load(save_path, map_location='cpu'))
+
+    def to_input(self, images):
+        # uint8 NHWC batches (arrays, tensors, lists of PIL images) or normalized NCHW float tensors
+        images = to_batch_tensor(images)
+        if images.dtype == torch.uint8:
+            images = images.to(self.device).permute(0, 3, 1, 2).float()
+            return images.mul_(1.0 / 127.5).sub_(1.0)
+        return images.to(self.device, dtype=torch.float32)
+
+    def autocast(self):
+        return torch.autocast(self.device.type, dtype=self.amp_dtype or torch.bfloat16,
+                              enabled=self.amp_dtype is not None)
+
+    def sample_z(self, num, generator=None):
+        return torch.rand([num, self.z_dim, 1, 1], generator=generator) * 2.0 - 1.0
+
+    def encode(self, part1, part2, part3):
+        # summed encoder features parts_enc and mask pyramid of a batch of key-patch triples
+        if self.patch_cache is None:
+            return self.encode_batch(self.to_input(part1), self.to_input(part2), self.to_input(part3))
+
+        num = part1.shape[0]
+        patch_keys = [[patch_key(part[i]) for i in range(num)] for part in [part1, part2, part3]]
+        triple_keys = ['|'.join([patch_keys[j][i] for j in range(3)]) for i in range(num)]
+        triples = [self.triple_cache.get(key) for key in triple_keys]
+        missing = [i for i in range(num) if triples[i] is None]
+
+        if missing:
+            # encode each missing patch once, all in a single encoder pass. Cache hits are kept in
+            # patch_encs: putting the new patches may evict them from the cache.
+            patch_encs = {}
+            new_patches = OrderedDict()
+            for j, part in enumerate([part1, part2, part3]):
+                for i in missing:
+                    key = patch_keys[j][i]
+                    if key in patch_encs or key in new_patches:
+                        continue
+                    cached = self.patch_cache.get(key)
+                    if cached is None:
+                        new_patches[key] = part[i:i+1]
+                    else:
+                        patch_encs[key] = cached
+            if new_patches:
+                parts_enc_out = self.net_part_encoder(self.to_input(torch.cat(list(new_patches.values()), 0)))
+                for n, key in enumerate(new_patches.keys()):
+                    patch_encs[key] = [out[n:n+1] for out in parts_enc_out]
+                    self.patch_cache.put(key, [out.clone() for out in patch_encs[key]])
+
+            num_levels = len(self.net_part_encoder.model)
+            parts_enc = [torch.cat([patch_encs[patch_keys[0][i]][l] + patch_encs[patch_keys[1][i]][l] +
+                                    patch_encs[patch_keys[2][i]][l] for i in missing], 0)
+                         for l in range(num_levels)]
+            gen_mask_output = self.net_mask_generator(parts_enc)
+            for n, i in enumerate(missing):
+                triples[i] = [out[n:n+1] for out in parts_enc] + [out[n:n+1] for out in gen_mask_output]
+                self.triple_cache.put(triple_keys[i], [out.clone() for out in triples[i]])
+
+        num_levels = len(self.net_part_encoder.model)
+        outputs = [torch.cat([triple[l] for triple in triples], 0) for l in range(len(triples[0]))]
+        return outputs[:num_levels], outputs[num_levels:]
+
+    def encode_batch(self, part1, part2, part3):
+        num = part1.shape[0]
+        parts_enc_out = self.net_part_encoder(torch.cat([part1, part2, part3], 0))
+        parts_enc = [out.view((3, num) + out.shape[1:]).sum(0) for out in parts_enc_out]
+        gen_mask_output = self.net_mask_generator(parts_enc)
+        return parts_enc, gen_mask_output
+
+    def generate(self, part1, part2, part3, z=None, generator=None):
+        """Generate images (N, c_dim, S, S) in [-1, 1] and masks (N, 1, S, S) for N key-patch triples.
+
+        Any N is accepted; it is processed in chunks of at most opts.infer_batch_size.
+        Encoder outputs and masks of previously seen patches come from the embedding cache.
+        """
+        part1 = to_batch_tensor(part1)
+        part2 = to_batch_tensor(part2)
+        part3 = to_batch_tensor(part3)
+        num = part1.shape[0]
+        if z is None:
+            z = self.sample_z(num, generator)
+        z = z.to(self.device, dtype=torch.float32)
+
+        images = []
+        masks = []
+        with torch.no_grad(), self.autocast():
+            for start in range(0, num, self.max_batch_size):
+                end = min(num, start + self.max_batch_size)
+                parts_enc, gen_mask_output = self.encode(part1[start:end], part2[start:end], part3[start:end])
+                image_gen_output = self.net_generator(parts_enc[-1], z[start:end], gen_mask_output)
+                images.append(image_gen_output[-1].float())
+                masks.append(gen_mask_output[-1].float())
+        return torch.cat(images, 0), torch.cat(masks, 0)
+
+    def sample_many(self, part1, part2, part3, num_z, z=None, generator=None):
+        """Generate num_z images per key-patch triple: images (N, num_z, c_dim, S, S), masks (N, 1, S, S).
+
+        The mask pyramid does not depend on z, so it is computed once per triple and only the image
+        generator runs over the N * num_z samples, in chunks of at most opts.infer_memory_mb activations.
+        """
+        part1 = to_batch_tensor(part1)
+        part2 = to_batch_tensor(part2)
+        part3 = to_batch_tensor(part3)
+        num = part1.shape[0]
+        if z is None:
+            z = self.sample_z(num * num_z, generator)
+        z = z.to(self.device, dtype=torch.float32).view(num * num_z, self.z_dim, 1, 1)
+
+        with torch.no_grad(), self.autocast():
+            parts_enc = []
+            gen_mask_output = []
+            for start in range(0, num, self.max_batch_size):
+                end = min(num, start + self.max_batch_size)
+                chunk_enc, chunk_mask = self.encode(part1[start:end], part2[start:end], part3[start:end])
+                parts_enc.append(chunk_enc[-1])
+                gen_mask_output.append(chunk_mask)
+            embed = torch.cat(parts_enc, 0)
+            gen_mask_output = [torch.cat(masks, 0) for masks in zip(*gen_mask_output)]
+
+            chunk_size = max(1, self.max_sample_bytes // self.get_sample_bytes(embed, gen_mask_output))
+            images = []
+            for start in range(0, num * num_z, chunk_size):
+                end = min(num * num_z, start + chunk_size)
+                index = torch.arange(start, end, device=self.device) // num_z
+                image_gen_output = self.net_generator(embed.index_select(0, index), z[start:end],
+                                                      [m.index_select(0, index) for m in gen_mask_output])
+                images.append(image_gen_output[-1].float())
+        images = torch.cat(images, 0)
+        return images.view((num, num_z) + images.shape[1:]), gen_mask_output[-1].float()
+
+    def get_sample_bytes(self, embed, gen_mask_output):
+        # activation memory of one image generator sample, measured once with a single sample
+        if self.sample_bytes is None:
+            z = torch.zeros([1, self.z_dim, 1, 1], device=self.device)
+            masks = [m[:1] for m in gen_mask_output]
+            image_gen_output = self.net_generator(embed[:1], z, masks)
+            self.sample_bytes = tensors_nbytes(image_gen_output) + tensors_nbytes(masks)
+        return self.sample_bytes
+
+    def generate_requests(self, requests, generator=None):
+        """Dynamic batching over requests of different sizes.
+
+        requests: list of (part1, part2, part3) or (part1, part2, part3, z) batches, all in the same format.
+        Requests are concatenated into full batches and the outputs split back per request.
+        """
+        sizes = []
+        parts = [[], [], []]
+        zs = []
+        for request in requests:
+            request_parts = [to_batch_tensor(request[j]) for j in range(3)]
+            num = request_parts[0].shape[0]
+            z = request[3] if len(request) > 3 and request[3] is not None else self.sample_z(num, generator)
+            for j in range(3):
+                parts[j].append(request_parts[j])
+            zs.append(z.to(self.device, dtype=torch.float32))
+            sizes.append(num)
+
+        images, masks = self.generate(torch.cat(parts[0], 0), torch.cat(parts[1], 0), torch.cat(parts[2], 0),
+                                      torch.cat(zs, 0))
+        return list(zip(images.split(sizes, 0), masks.split(sizes, 0)))
+
+    def name(self):
+        return 'KeyPatchGanGenerator'
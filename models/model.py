@@ -1,17 +1,22 @@
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
-from torch.autograd import Variable
-import torchvision.transforms as transforms
 from collections import OrderedDict
 import numpy as np
 import itertools
-from PIL import Image
 import os
 import time
 from .networks import PartEncoderR, DiscriminatorR, MaskGeneratorR, ImageGeneratorR
-from .networks import PartEncoderU, DiscriminatorU, MaskGeneratorU, ImageGeneratorU
-from utils.my_utils import weights_init
+from .networks import PartEncoderU, DiscriminatorU, MaskGeneratorU, ImageGeneratorU, get_num_conv_layers, \
+    keep_norm_fp32, fold_batchnorm
+from utils.my_utils import weights_init, to_batch_tensor
+from utils.checkpoint import CheckpointWriter, checkpoint_name, list_checkpoints, network_name, save_dir_name, \
+    snapshot, unwrap
+from utils.profiler import Profiler
+from utils.my_utils import connect_visdom
+from utils.startup import startup_timer
+from utils.image_writer import ImageWriter, make_grid
+from utils.distributed import convert_sync_batchnorm, no_grad_sync, all_reduce_mean, is_main_process
 
 
 
@@ -26,35 +31,47 @@ class KeyPatchGanModel():
         self.output_size = self.opts.output_size
         self.z_dim       = self.opts.z_dim
 
-        save_dir_str = str(opts.model_structure) + '_o' + str(opts.output_size) + '_b' + str(opts.batch_size) + \
-                        '_df' + str(opts.conv_dim) + '_epch' + str(opts.epoch)
+        # with --distributed, only rank 0 writes checkpoints, images and logs
+        self.is_main = is_main_process(opts)
+
+        save_dir_str = save_dir_name(opts)
         self.sample_dir = os.path.join(opts.sample_dir, opts.db_name, save_dir_str)
         self.test_dir = os.path.join(opts.test_dir, opts.db_name, save_dir_str)
         self.net_save_dir = os.path.join(opts.net_dir, opts.db_name, save_dir_str)
-        if not os.path.exists(self.sample_dir):
-            os.makedirs(self.sample_dir)
-        if not os.path.exists(self.test_dir):
-            os.makedirs(self.test_dir)
-        if not os.path.exists(self.net_save_dir):
-            os.makedirs(self.net_save_dir)
-
-        self.Tensor = torch.Tensor
-
-        transform_list = [transforms.ToTensor(),
-                          transforms.Normalize((0.5, 0.5, 0.5),
-                                               (0.5, 0.5, 0.5))]
-
-        self.transform = transforms.Compose(transform_list)
-
-        # input part1, part2, part3, images, gtMast, z
-        self.input_image = Variable(self.Tensor(self.batch_size, self.c_dim, self.output_size, self.output_size))
-        self.shuff_image = Variable(self.Tensor(self.batch_size, self.c_dim, self.output_size, self.output_size))
-        self.input_part1  = Variable(self.Tensor(self.batch_size, self.c_dim, self.output_size, self.output_size))
-        self.input_part2  = Variable(self.Tensor(self.batch_size, self.c_dim, self.output_size, self.output_size))
-        self.input_part3  = Variable(self.Tensor(self.batch_size, self.c_dim, self.output_size, self.output_size))
-        self.input_z      = Variable(self.Tensor(self.batch_size, self.z_dim, 1, 1))
-        self.gt_mask      = Variable(self.Tensor(self.batch_size, 1, self.output_size, self.output_size))
-        self.weight_g_loss = Variable(self.Tensor(1))
+        if self.is_main:
+            if not os.path.exists(self.sample_dir):
+                os.makedirs(self.sample_dir)
+            if not os.path.exists(self.test_dir):
+                os.makedirs(self.test_dir)
+            if not os.path.exists(self.net_save_dir):
+                os.makedirs(self.net_save_dir)
+        self.profiler = Profiler()
+        self.profiler.initialize(opts)
+        self.checkpoint_writer = CheckpointWriter()
+        self.checkpoint_writer.initialize(self.net_save_dir, keep_last=opts.keep_checkpoints)
+        self.image_writer = ImageWriter()
+        self.image_writer.initialize(opts.image_format, opts.image_compression,
+                                     opts.image_writer_threads, opts.image_queue)
+
+        if self.opts.use_gpu and not torch.cuda.is_available():
+            print('CUDA is not available, running on CPU')
+            self.opts.use_gpu = False
+            self.opts.use_multigpu = False
+        if self.opts.use_gpu and self.opts.distributed:
+            self.device = torch.device('cuda', self.opts.local_rank)
+        elif self.opts.use_gpu:
+            self.device = torch.device('cuda', 0 if self.opts.use_multigpu else self.opts.gpu_id)
+        else:
+            self.device = torch.device('cpu')
+
+        # persistent input buffers, refilled in place by set_inputs_for_train/test
+        self.input_buffers = {}
+        # constant GAN labels per (shape, value), and losses summed on the device until pop_losses
+        self.label_tensors = {}
+        self.loss_sums = OrderedDict()
+        self.loss_counts = {}
+        self.weight_mask_loss = 0.0
+        self.weight_appr_loss = 0.0
 
         # define networks
         if self.opts.model_structure == 'resblock':
@@ -69,14 +86,7 @@ class KeyPatchGanModel():
                                                      repeat_num=self.opts.res_n_repeat)
         else:
             # find depth of network
-            num_conv_layers = 0
-            osize = self.opts.output_size / 4
-            while (True):
-                osize = osize / 2
-                if osize < 1:
-                    break
-                num_conv_layers = num_conv_layers + 1
-            self.opts.num_conv_layers = num_conv_layers
+            self.opts.num_conv_layers = get_num_conv_layers(self.opts.output_size)
             self.net_discriminator = DiscriminatorU(self.opts)
             self.net_generator = ImageGeneratorU(self.opts)
             self.net_part_encoder = PartEncoderU(self.opts)
@@ -86,17 +96,48 @@ class KeyPatchGanModel():
             # self.net_part_encoder.apply(weights_init)
             # self.net_mask_generator.apply(weights_init)
 
-        if self.opts.cont_train:
+        # mixed precision: only the network forwards are autocast
+        self.device_type = self.device.type
+        self.amp_dtype = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[self.opts.precision]
+        if self.amp_dtype is not None:
+            for network in [self.net_discriminator, self.net_generator, self.net_part_encoder, self.net_mask_generator]:
+                keep_norm_fp32(network)
+        # fp16 gradients underflow without loss scaling; bf16 has the fp32 exponent range
+        self.grad_scaler = torch.amp.GradScaler(self.device_type, enabled=self.opts.precision == 'fp16')
+
+        if self.opts.distributed and self.opts.sync_bn:
+            self.net_discriminator = convert_sync_batchnorm(self.net_discriminator)
+            self.net_generator = convert_sync_batchnorm(self.net_generator)
+            self.net_part_encoder = convert_sync_batchnorm(self.net_part_encoder)
+            self.net_mask_generator = convert_sync_batchnorm(self.net_mask_generator)
+
+        if self.opts.cont_train and not list_checkpoints(self.net_save_dir):
+            # no full checkpoint yet, continue after the per-network weights of start_epoch
             self.load(self.opts.start_epoch)
 
+        # Stacked batches (three key parts, D inputs) keep per-sub-batch BatchNorm statistics.
+        # DataParallel would split them across devices, so for the U-Net this needs a single device
+        self.chunk_batches = not (self.opts.use_gpu and self.opts.use_multigpu and
+                                  self.opts.model_structure != 'resblock')
+        self.fuse_part_encoder = self.opts.fuse_part_encoder and self.chunk_batches
+
         if self.opts.use_gpu:
             if self.opts.use_multigpu:
-                self.net_discriminator = nn.DataParallel(self.net_discriminator).cuda()
-                self.net_generator = nn.DataParallel(self.net_generator).cuda()
-                self.net_part_encoder = nn.DataParallel(self.net_part_encoder).cuda()
-                self.net_mask_generator = nn.DataParallel(self.net_mask_generator).cuda()
+                self.net_discriminator = nn.DataParallel(self.net_discriminator)
+                self.net_generator = nn.DataParallel(self.net_generator)
+                self.net_part_encoder = nn.DataParallel(self.net_part_encoder)
+                self.net_mask_generator = nn.DataParallel(self.net_mask_generator)
             else:
-                torch.cuda.set_device(self.opts.gpu_id)
+                torch.cuda.set_device(self.device)
+        self.net_discriminator.to(self.device)
+        self.net_generator.to(self.device)
+        self.net_part_encoder.to(self.device)
+        self.net_mask_generator.to(self.device)
+        if self.opts.distributed:
+            self.net_discriminator = self.wrap_distributed(self.net_discriminator)
+            self.net_generator = self.wrap_distributed(self.net_generator)
+            self.net_part_encoder = self.wrap_distributed(self.net_part_encoder)
+            self.net_mask_generator = self.wrap_distributed(self.net_mask_generator)
 
         # define optimizer
         self.criterionMask = torch.nn.L1Loss(size_average=False)
@@ -112,13 +153,45 @@ class KeyPatchGanModel():
                                             lr=self.opts.learning_rate,
                                             betas=(self.opts.beta1, 0.999))
 
-        if self.opts.use_tensorboard:
-            from utils.logger import Logger
-            self.logger = Logger(self.opts.tb_log_path)
+        # where main.py continues training; see load_checkpoint
+        self.resume_state = None
+        if self.opts.cont_train:
+            self.resume_state = self.load_checkpoint()
+            if self.resume_state is None:
+                self.resume_state = {'epoch': self.opts.start_epoch + 1, 'iteration': 0}
+
+        # tensorboard logger and visdom client are created on first use
+        self._logger = None
+        self._vis = None
+
+    def wrap_distributed(self, network):
+        # synchronized BatchNorm keeps the running stats equal on all ranks, no need to broadcast them
+        device_ids = [self.device] if self.device.type == 'cuda' else None
+        return nn.parallel.DistributedDataParallel(network, device_ids=device_ids,
+                                                   broadcast_buffers=not self.opts.sync_bn)
 
-        if self.opts.use_visdom:
-            import visdom
-            self.vis = visdom.Visdom(port=self.opts.visdom_port)
+    @property
+    def logger(self):
+        if self._logger is None:
+            with startup_timer.stage('tensorboard logger'):
+                from utils.logger import Logger
+                self._logger = Logger(self.opts.tb_log_path)
+        return self._logger
+
+    @property
+    def vis(self):
+        if self._vis is None:
+            with startup_timer.stage('visdom'):
+                self._vis = connect_visdom(self.opts.visdom_port)
+        return self._vis
+
+    def close(self):
+        # waits for pending checkpoint and image writes and flushes the logs
+        self.checkpoint_writer.close()
+        self.image_writer.close()
+        self.profiler.close()
+        if self._logger is not None:
+            self._logger.close()
 
 
 
@@ -127,12 +200,20 @@ class KeyPatchGanModel():
 
     def forward(self):
 
+        if self.fuse_part_encoder:
+            # encode the three key parts in a single pass over a 3*B batch
+            input_parts = torch.cat([self.input_part1, self.input_part2, self.input_part3], 0)
+
         if self.opts.model_structure == 'resblock':
             ''' Encoding Key parts '''
-            self.part_enc1 = self.net_part_encoder(self.input_part1)
-            self.part_enc2 = self.net_part_encoder(self.input_part2)
-            self.part_enc3 = self.net_part_encoder(self.input_part3)
-            self.parts_enc = self.part_enc1 + self.part_enc2 + self.part_enc3
+            if self.fuse_part_encoder:
+                parts_enc_out = self.net_part_encoder(input_parts)
+                self.parts_enc = parts_enc_out.view((3, -1) + parts_enc_out.shape[1:]).sum(0)
+            else:
+                self.part_enc1 = self.net_part_encoder(self.input_part1)
+                self.part_enc2 = self.net_part_encoder(self.input_part2)
+                self.part_enc3 = self.net_part_encoder(self.input_part3)
+                self.parts_enc = self.part_enc1 + self.part_enc2 + self.part_enc3
             ''' Generating mask'''
             self.gen_mask = self.net_mask_generator(self.parts_enc)
             ''' Generating Full image'''
@@ -140,12 +221,17 @@ class KeyPatchGanModel():
         else:
             # that means, 'U-net' structure
             ''' Encoding Key parts '''
-            self.part1_enc_out = self.net_part_encoder(self.input_part1)
-            self.part2_enc_out = self.net_part_encoder(self.input_part2)
-            self.part3_enc_out = self.net_part_encoder(self.input_part3)
-            self.parts_enc = []
-            for val in range(len(self.part1_enc_out)):
-                self.parts_enc.append(self.part1_enc_out[val] + self.part2_enc_out[val] + self.part3_enc_out[val])
+            if self.fuse_part_encoder:
+                # BatchNorm statistics are still computed per part (see forward_chunked)
+                parts_enc_out = self.net_part_encoder(input_parts, num_chunks=3)
+                self.parts_enc = [out.view((3, -1) + out.shape[1:]).sum(0) for out in parts_enc_out]
+            else:
+                self.part1_enc_out = self.net_part_encoder(self.input_part1)
+                self.part2_enc_out = self.net_part_encoder(self.input_part2)
+                self.part3_enc_out = self.net_part_encoder(self.input_part3)
+                self.parts_enc = []
+                for val in range(len(self.part1_enc_out)):
+                    self.parts_enc.append(self.part1_enc_out[val] + self.part2_enc_out[val] + self.part3_enc_out[val])
 
             ''' Generating mask'''
             self.gen_mask_output = self.net_mask_generator(self.parts_enc)
@@ -158,27 +244,41 @@ class KeyPatchGanModel():
 
 
 
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.amp_dtype or torch.bfloat16,
+                              enabled=self.amp_dtype is not None)
+
+    def run_discriminator(self, images):
+        # a single D forward over the stacked image batches, logits split afterwards
+        if self.chunk_batches:
+            d_out = self.net_discriminator(torch.cat(images, 0), num_chunks=len(images))
+            return d_out.chunk(len(images), 0)
+        return [self.net_discriminator(image) for image in images]
+
     def backward_D(self):
-        self.genpart_realbg = torch.mul(self.image_gen, self.gt_mask) + \
-                              torch.mul(self.input_image, 1 - self.gt_mask)  # GR
-        self.realpart_genbg = torch.mul(self.image_gen, 1 - self.gt_mask) + \
-                              torch.mul(self.input_image, self.gt_mask)  # RG
+        image_gen = self.image_gen.detach().float()
         self.shfpart_realbg = torch.mul(self.shuff_image, self.gt_mask) + \
                               torch.mul(self.input_image, 1 - self.gt_mask)  # SR
         self.realpart_shfbg = torch.mul(self.input_image, self.gt_mask) + \
                               torch.mul(self.shuff_image, 1 - self.gt_mask)  # RS
+        d_inputs = [self.input_image, image_gen, self.shfpart_realbg, self.realpart_shfbg]
+
+        if self.opts.d_extra_composites:
+            self.genpart_realbg = torch.mul(image_gen, self.gt_mask) + \
+                                  torch.mul(self.input_image, 1 - self.gt_mask)  # GR
+            self.realpart_genbg = torch.mul(image_gen, 1 - self.gt_mask) + \
+                                  torch.mul(self.input_image, self.gt_mask)  # RG
+            d_inputs += [self.genpart_realbg, self.realpart_genbg]
 
-        self.d_real = self.net_discriminator(self.input_image.detach())
-        self.d_gen = self.net_discriminator(self.image_gen.detach())
-        self.d_genpart_realbg = self.net_discriminator(self.genpart_realbg.detach())
-        self.d_realpart_genbg = self.net_discriminator(self.realpart_genbg.detach())
-        self.d_shfpart_realbg = self.net_discriminator(self.shfpart_realbg.detach())
-        self.d_realpart_shfbg = self.net_discriminator(self.realpart_shfbg.detach())
+        with self.autocast():
+            d_outs = self.run_discriminator(d_inputs)
+        # BCELoss is not autocast-safe, the discriminator outputs are compared in fp32 (the
+        # Sigmoid of DiscriminatorU already runs in fp32, see keep_norm_fp32)
+        d_outs = [d_out.float() for d_out in d_outs]
+        self.d_real, self.d_gen, self.d_shfpart_realbg, self.d_realpart_shfbg = d_outs[:4]
 
-        true_tensor = Variable(self.Tensor(self.d_real.data.size()).fill_(1.0))
-        true_tensor = true_tensor.cuda()
-        fake_tensor = Variable(self.Tensor(self.d_real.data.size()).fill_(0.0))
-        fake_tensor = fake_tensor.cuda()
+        true_tensor = self.get_label(self.d_real, 1.0)
+        fake_tensor = self.get_label(self.d_real, 0.0)
 
         d_loss_real = self.criterionGAN(self.d_real, true_tensor)
         d_loss_fake = self.criterionGAN(self.d_gen, fake_tensor)
@@ -187,34 +287,74 @@ class KeyPatchGanModel():
 
         self.d_loss = d_loss_real + d_loss_fake + \
                       d_loss_shfpart_realbg + d_loss_realpart_shfbg
-        self.d_loss.backward()
-
-        self.loss['D/loss_all'] = self.d_loss.data[0]
-        self.loss['D/loss_real'] = d_loss_real.data[0]
-        self.loss['D/loss_fake'] = d_loss_fake.data[0]
-        self.loss['D/loss_shfpart_realbg'] = d_loss_shfpart_realbg.data[0]
-        self.loss['D/loss_realpart_shfbg'] = d_loss_realpart_shfbg.data[0]
+        if self.opts.d_extra_composites:
+            self.d_genpart_realbg, self.d_realpart_genbg = d_outs[4:]
+            d_loss_genpart_realbg = self.criterionGAN(self.d_genpart_realbg, fake_tensor)
+            d_loss_realpart_genbg = self.criterionGAN(self.d_realpart_genbg, fake_tensor)
+            self.d_loss = self.d_loss + d_loss_genpart_realbg + d_loss_realpart_genbg
+        self.grad_scaler.scale(self.d_loss).backward()
+
+        self.accumulate_loss('D/loss_all', self.d_loss)
+        self.accumulate_loss('D/loss_real', d_loss_real)
+        self.accumulate_loss('D/loss_fake', d_loss_fake)
+        self.accumulate_loss('D/loss_shfpart_realbg', d_loss_shfpart_realbg)
+        self.accumulate_loss('D/loss_realpart_shfbg', d_loss_realpart_shfbg)
+        if self.opts.d_extra_composites:
+            self.accumulate_loss('D/loss_genpart_realbg', d_loss_genpart_realbg)
+            self.accumulate_loss('D/loss_realpart_genbg', d_loss_realpart_genbg)
 
 
     def backward_G(self):
-        self.d_real = self.net_discriminator(self.input_image)
-        self.d_gen = self.net_discriminator(self.image_gen)
-        self.real_gtpart = torch.mul(self.input_image, self.gt_mask)  # realpart
-        self.gen_genpart = torch.mul(self.image_gen, self.gen_mask)  # genpart
-
-        true_tensor = Variable(self.Tensor(self.d_real.size()).fill_(1.0))
-        true_tensor = true_tensor.cuda()
-
-        self.g_loss_l1_mask = self.criterionMask(self.gen_mask, self.gt_mask) * self.weight_mask_loss
-        self.g_loss_l1_appr = self.criterionAppr(self.gen_genpart, self.real_gtpart) * self.weight_appr_loss
-        self.g_loss_gan = self.criterionGAN(self.d_gen, true_tensor)
-        self.g_loss = self.g_loss_l1_mask + self.g_loss_l1_appr + self.g_loss_gan
-        self.g_loss.backward()
+        # d_real is not part of the G loss, so only the generated images go through D.
+        # The D gradients of this pass are discarded, so they are not all-reduced either
+        with no_grad_sync(self.net_discriminator):
+            with self.autocast():
+                self.d_gen = self.net_discriminator(self.image_gen).float()
+            gen_mask = self.gen_mask.float()
+            self.real_gtpart = torch.mul(self.input_image, self.gt_mask)  # realpart
+            self.gen_genpart = torch.mul(self.image_gen.float(), gen_mask)  # genpart
+
+            true_tensor = self.get_label(self.d_gen, 1.0)
+
+            self.g_loss_l1_mask = self.criterionMask(gen_mask, self.gt_mask) * self.weight_mask_loss
+            self.g_loss_l1_appr = self.criterionAppr(self.gen_genpart, self.real_gtpart) * self.weight_appr_loss
+            self.g_loss_gan = self.criterionGAN(self.d_gen, true_tensor)
+            self.g_loss = self.g_loss_l1_mask + self.g_loss_l1_appr + self.g_loss_gan
+            self.grad_scaler.scale(self.g_loss).backward()
+
+            self.accumulate_loss('G/loss_all', self.g_loss)
+            self.accumulate_loss('G/loss_fake', self.g_loss_gan)
+            self.accumulate_loss('G/loss_mask', self.g_loss_l1_mask)
+            self.accumulate_loss('G/loss_appr', self.g_loss_l1_appr)
+
+    def get_label(self, output, value):
+        key = (tuple(output.shape), value)
+        label = self.label_tensors.get(key)
+        if label is None or label.device != output.device:
+            label = torch.full(output.shape, value, dtype=torch.float32, device=output.device)
+            self.label_tensors[key] = label
+        return label
+
+    def accumulate_loss(self, name, loss):
+        # stays on the device, no host sync per step
+        loss = loss.detach().float()
+        if name in self.loss_sums:
+            self.loss_sums[name] = self.loss_sums[name] + loss
+            self.loss_counts[name] += 1
+        else:
+            self.loss_sums[name] = loss
+            self.loss_counts[name] = 1
 
-        self.loss['G/loss_all'] = self.g_loss.data[0]
-        self.loss['G/loss_fake'] = self.g_loss_gan.data[0]
-        self.loss['G/loss_mask'] = self.g_loss_l1_mask.data[0]
-        self.loss['G/loss_appr'] = self.g_loss_l1_appr.data[0]
+    def pop_losses(self):
+        # mean of every loss since the last call, copied to the host in one transfer
+        if not self.loss_sums:
+            return OrderedDict()
+        names = list(self.loss_sums.keys())
+        sums = all_reduce_mean(torch.stack([self.loss_sums[name] for name in names]), self.opts).cpu().numpy()
+        losses = OrderedDict((name, float(sums[k]) / self.loss_counts[name]) for k, name in enumerate(names))
+        self.loss_sums = OrderedDict()
+        self.loss_counts = {}
+        return losses
 
 
 
@@ -222,15 +362,40 @@ class KeyPatchGanModel():
 
     def optimize_parameters_D(self):
         self.optimizer_D.zero_grad()
-        self.backward_D()
-        self.optimizer_D.step()
+        with self.profiler.stage('backward_D'):
+            self.backward_D()
+        with self.profiler.stage('optimizer_D'):
+            self.grad_scaler.step(self.optimizer_D)
 
     def optimize_parameters_G(self):
         self.optimizer_G.zero_grad()
-        self.backward_G()
-        self.optimizer_G.step()
+        with self.profiler.stage('backward_G'):
+            self.backward_G()
+        with self.profiler.stage('optimizer_G'):
+            self.grad_scaler.step(self.optimizer_G)
+
+    def train_step(self, i):
+        # One generator forward is shared by the D update (on detached outputs) and the G update,
+        # which runs on every d_steps_per_g-th iteration. Without a G update the forward keeps no graph.
+        update_G = i % self.opts.d_steps_per_g == self.opts.d_steps_per_g - 1
+
+        with self.profiler.stage('forward'), self.autocast():
+            if update_G:
+                self.forward()
+            else:
+                with torch.no_grad():
+                    self.forward()
+
+        self.optimize_parameters_D()
+        if update_G:
+            self.optimize_parameters_G()
+        # one loss scale for both optimizers, adjusted once per iteration
+        self.grad_scaler.update()
+        return update_G
 
     def visualize(self, win_offset=0):
+        if not self.is_main:
+            return
 
         # show input image
         # show gen image
@@ -247,111 +412,122 @@ class KeyPatchGanModel():
         self.vis.images(gt_mask,     win=win_offset+3, opts=dict(title='gt masks'))
 
     def save_images(self, epoch, iter, is_test=False):
-        num_img_rows = 7
+        # rows: key parts 1-3, input, generated, predicted mask * generated, gt mask * input.
+        # The grid is built on the device; encoding and writing happen on the image writer threads
+        if not self.is_main:
+            return
         num_img_cols = 16
 
-        input_image = (self.input_image[0:num_img_cols].cpu().data + 1.0) / 2.0
-        input_part1 = (self.input_part1[0:num_img_cols].cpu().data + 1.0) / 2.0
-        input_part2 = (self.input_part2[0:num_img_cols].cpu().data + 1.0) / 2.0
-        input_part3 = (self.input_part3[0:num_img_cols].cpu().data + 1.0) / 2.0
-        image_gen   = (self.image_gen[0:num_img_cols].cpu().data + 1.0) / 2.0
-        gen_mask    = (self.gen_mask[0:num_img_cols].cpu().data)
-        gen_mask    = gen_mask * image_gen
-        gt_mask     = (self.gt_mask[0:num_img_cols].cpu().data)
-        gt_mask     = gt_mask * input_image
-
-        input_image_pil = [transforms.ToPILImage()(input_image[i]) for i in range(input_image.shape[0])]
-        input_part1_pil = [transforms.ToPILImage()(input_part1[i]) for i in range(input_part1.shape[0])]
-        input_part2_pil = [transforms.ToPILImage()(input_part2[i]) for i in range(input_part2.shape[0])]
-        input_part3_pil = [transforms.ToPILImage()(input_part3[i]) for i in range(input_part3.shape[0])]
-        image_gen_pil   = [transforms.ToPILImage()(image_gen[i])   for i in range(image_gen.shape[0])]
-        gen_mask_pil    = [transforms.ToPILImage()(gen_mask[i])    for i in range(gen_mask.shape[0])]
-        gt_mask_pil     = [transforms.ToPILImage()(gt_mask[i])     for i in range(gt_mask.shape[0])]
-
-        im_w = input_image.shape[2]
-        im_h = input_image.shape[3]
-
-        image_save = Image.new('RGB', (num_img_cols*im_w, num_img_rows*im_h))
-
-        for i in range(num_img_cols):
-            image_save.paste(input_part1_pil[i],   (im_w*i, im_h*0))
-            image_save.paste(input_part2_pil[i],   (im_w*i, im_h*1))
-            image_save.paste(input_part3_pil[i],   (im_w*i, im_h*2))
-            image_save.paste(input_image_pil[i],   (im_w*i, im_h*3))
-            image_save.paste(image_gen_pil[i],     (im_w*i, im_h*4))
-            image_save.paste(gen_mask_pil[i],      (im_w*i, im_h*5))
-            image_save.paste(gt_mask_pil[i],       (im_w*i, im_h*6))
-
-        save_name = "epoch_%02d_iter_%04d.png" %(epoch, iter)
+        input_image = (self.input_image[0:num_img_cols].detach().float() + 1.0) / 2.0
+        input_part1 = (self.input_part1[0:num_img_cols].detach().float() + 1.0) / 2.0
+        input_part2 = (self.input_part2[0:num_img_cols].detach().float() + 1.0) / 2.0
+        input_part3 = (self.input_part3[0:num_img_cols].detach().float() + 1.0) / 2.0
+        image_gen   = (self.image_gen[0:num_img_cols].detach().float() + 1.0) / 2.0
+        gen_mask    = self.gen_mask[0:num_img_cols].detach().float() * image_gen
+        gt_mask     = self.gt_mask[0:num_img_cols].detach().float() * input_image
+
+        grid = make_grid([input_part1, input_part2, input_part3, input_image, image_gen, gen_mask, gt_mask])
+
+        save_name = "epoch_%02d_iter_%04d.%s" %(epoch, iter, self.image_writer.extension())
         if is_test:
             save_image_path = os.path.join(self.test_dir, save_name)
         else:
             save_image_path = os.path.join(self.sample_dir, save_name)
 
-        image_save.save(save_image_path)
+        self.image_writer.write(grid, save_image_path)
 
 
     def set_inputs_for_test(self, input_image, input_part1, input_part2, input_part3, z):
-        self.input_image = Variable(self.Tensor(self.batch_size, self.c_dim, self.output_size, self.output_size))
-        self.input_part1  = Variable(self.Tensor(self.batch_size, self.c_dim, self.output_size, self.output_size))
-        self.input_part2  = Variable(self.Tensor(self.batch_size, self.c_dim, self.output_size, self.output_size))
-        self.input_part3  = Variable(self.Tensor(self.batch_size, self.c_dim, self.output_size, self.output_size))
-        self.input_z = Variable(z)
-
-        # stack tensors
-        for i in range(len(input_image)):
-            self.input_image[i,:,:,:] = self.transform(input_image[i])
-            self.input_part1[i,:,:,:] = self.transform(input_part1[i])
-            self.input_part2[i,:,:,:] = self.transform(input_part2[i])
-            self.input_part3[i,:,:,:] = self.transform(input_part3[i])
-
-        if self.opts.use_gpu:
-            self.input_image = self.input_image.cuda()
-            self.input_part1 = self.input_part1.cuda()
-            self.input_part2 = self.input_part2.cuda()
-            self.input_part3 = self.input_part3.cuda()
-            self.input_z     = self.input_z.cuda()
+        self.input_image = self.fill_input_buffer('input_image', input_image)
+        self.input_part1 = self.fill_input_buffer('input_part1', input_part1)
+        self.input_part2 = self.fill_input_buffer('input_part2', input_part2)
+        self.input_part3 = self.fill_input_buffer('input_part3', input_part3)
+        self.input_z     = self.fill_input_buffer('input_z', z, normalize=False)
 
 
     def set_inputs_for_train(self, input_image, shuff_image, input_part1, input_part2, input_part3,
                    z, gt_mask, weight_g_loss1, weight_g_loss2):
-
-        self.input_image   = Variable(self.Tensor(self.batch_size, self.c_dim, self.output_size, self.output_size))
-        self.shuff_image   = Variable(self.Tensor(self.batch_size, self.c_dim, self.output_size, self.output_size))
-        self.input_part1   = Variable(self.Tensor(self.batch_size, self.c_dim, self.output_size, self.output_size))
-        self.input_part2   = Variable(self.Tensor(self.batch_size, self.c_dim, self.output_size, self.output_size))
-        self.input_part3   = Variable(self.Tensor(self.batch_size, self.c_dim, self.output_size, self.output_size))
-        self.gt_mask       = Variable(self.Tensor(self.batch_size, 1, self.output_size, self.output_size))
-        self.input_z       = Variable(z)
-        self.weight_mask_loss = Variable(self.Tensor([weight_g_loss1]))
-        self.weight_appr_loss = Variable(self.Tensor([weight_g_loss2]))
-
-        # stack tensors
-        for i in range(len(input_image)):
-            self.input_image[i,:,:,:] = self.transform(input_image[i])
-            self.shuff_image[i,:,:,:] = self.transform(shuff_image[i])
-            self.input_part1[i,:,:,:] = self.transform(input_part1[i])
-            self.input_part2[i,:,:,:] = self.transform(input_part2[i])
-            self.input_part3[i,:,:,:] = self.transform(input_part3[i])
-            self.gt_mask[i,0,:,:] = gt_mask[i]
-
-        if self.opts.use_gpu:
-            self.input_image = self.input_image.cuda()
-            self.shuff_image = self.shuff_image.cuda()
-            self.input_part1 = self.input_part1.cuda()
-            self.input_part2 = self.input_part2.cuda()
-            self.input_part3 = self.input_part3.cuda()
-            self.gt_mask    = self.gt_mask.cuda()
-            self.input_z    = self.input_z.cuda()
-            self.weight_g_loss = self.weight_g_loss.cuda()
-            self.weight_mask_loss = self.weight_mask_loss.cuda()
-            self.weight_appr_loss = self.weight_appr_loss.cuda()
-
-    def save(self, epoch):
-        self.save_network(self.net_discriminator, epoch, 'net_disc')
-        self.save_network(self.net_generator, epoch, 'net_imggen')
-        self.save_network(self.net_part_encoder, epoch, 'net_partenc')
-        self.save_network(self.net_mask_generator, epoch, 'net_maskgen')
+        # images are uint8 NHWC batches (arrays, tensors or lists of PIL images), gt_mask is (B, H, W)
+        self.input_image = self.fill_input_buffer('input_image', input_image)
+        self.shuff_image = self.fill_input_buffer('shuff_image', shuff_image)
+        self.input_part1 = self.fill_input_buffer('input_part1', input_part1)
+        self.input_part2 = self.fill_input_buffer('input_part2', input_part2)
+        self.input_part3 = self.fill_input_buffer('input_part3', input_part3)
+        self.gt_mask     = self.fill_input_buffer('gt_mask', gt_mask, normalize=False)
+        self.input_z     = self.fill_input_buffer('input_z', z, normalize=False)
+        self.weight_mask_loss = float(weight_g_loss1)
+        self.weight_appr_loss = float(weight_g_loss2)
+
+    def fill_input_buffer(self, name, data, normalize=True):
+        data = to_batch_tensor(data)
+        if normalize:
+            # NHWC uint8 -> NCHW in [-1, 1], same as ToTensor + Normalize((0.5,)*3, (0.5,)*3)
+            data = data.permute(0, 3, 1, 2)
+        elif data.dim() == 3:
+            # masks (B, H, W) -> (B, 1, H, W)
+            data = data.unsqueeze(1)
+
+        num = data.shape[0]
+        buf = self.input_buffers.get(name)
+        if buf is None or buf.shape[0] < num or buf.shape[1:] != data.shape[1:]:
+            buf = torch.empty(data.shape, dtype=torch.float32, device=self.device)
+            self.input_buffers[name] = buf
+
+        out = buf[:num]
+        out.copy_(data.to(out.device, non_blocking=True))
+        if normalize:
+            out.mul_(1.0 / 127.5).sub_(1.0)
+        return out
+
+    def save(self, epoch, train_state=None):
+        # per-network weights of a finished epoch, plus a full checkpoint to resume from the next one
+        # as one writer job, so the training loop does not wait for a free queue slot per file
+        if not self.is_main:
+            return
+        state = snapshot(self.checkpoint_state(epoch + 1, 0, train_state))
+        files = [(state[net_name], network_name(epoch, net_name))
+                 for net_name in ['net_disc', 'net_imggen', 'net_partenc', 'net_maskgen']]
+        files.append((state, checkpoint_name(epoch + 1, 0)))
+        self.checkpoint_writer.write_files(files)
+
+    def load_checkpoint(self):
+        # restores nets and optimizers from the latest full checkpoint and returns it, or None
+        ckpts = list_checkpoints(self.net_save_dir)
+        if not ckpts:
+            return None
+        save_path = os.path.join(self.net_save_dir, ckpts[-1][2])
+        print('Resuming from %s' % save_path)
+        state = torch.load(save_path, map_location='cpu')
+        unwrap(self.net_discriminator).load_state_dict(state['net_disc'])
+        unwrap(self.net_generator).load_state_dict(state['net_imggen'])
+        unwrap(self.net_part_encoder).load_state_dict(state['net_partenc'])
+        unwrap(self.net_mask_generator).load_state_dict(state['net_maskgen'])
+        self.optimizer_G.load_state_dict(state['optimizer_G'])
+        self.optimizer_D.load_state_dict(state['optimizer_D'])
+        if state.get('grad_scaler'):
+            self.grad_scaler.load_state_dict(state['grad_scaler'])
+        return state
+
+    def save_checkpoint(self, epoch, iteration, train_state=None):
+        # (epoch, iteration) is where training resumes; written in the background and rotated.
+        # train_state holds the loop state (RNG, epoch plan, loss weights) needed for an exact resume
+        if not self.is_main:
+            return
+        state = self.checkpoint_state(epoch, iteration, train_state)
+        self.checkpoint_writer.write(snapshot(state), checkpoint_name(epoch, iteration))
+
+    def checkpoint_state(self, epoch, iteration, train_state=None):
+        state = dict(train_state or {})
+        state.update({'epoch': epoch,
+                 'iteration': iteration,
+                 'net_disc': unwrap(self.net_discriminator).state_dict(),
+                 'net_imggen': unwrap(self.net_generator).state_dict(),
+                 'net_partenc': unwrap(self.net_part_encoder).state_dict(),
+                 'net_maskgen': unwrap(self.net_mask_generator).state_dict(),
+                 'optimizer_G': self.optimizer_G.state_dict(),
+                 'optimizer_D': self.optimizer_D.state_dict(),
+                 'grad_scaler': self.grad_scaler.state_dict()})
+        return state
 
     def load(self, epoch):
         self.load_network(self.net_discriminator, epoch, 'net_disc')
@@ -359,17 +535,33 @@ class KeyPatchGanModel():
         self.load_network(self.net_part_encoder, epoch, 'net_partenc')
         self.load_network(self.net_mask_generator, epoch, 'net_maskgen')
 
+    def strip_for_inference(self):
+        # Generation only (forward, save_images, visualize), in eval mode: drops the discriminator,
+        # optimizers and loss state and folds BatchNorm into the generator-side convs. No training afterwards.
+        self.net_discriminator = None
+        self.optimizer_D = None
+        self.optimizer_G = None
+        self.label_tensors = {}
+        self.loss_sums = OrderedDict()
+        self.loss_counts = {}
+        self.net_generator = unwrap(self.net_generator)
+        self.net_part_encoder = unwrap(self.net_part_encoder)
+        self.net_mask_generator = unwrap(self.net_mask_generator)
+        num_folded = 0
+        for network in [self.net_generator, self.net_part_encoder, self.net_mask_generator]:
+            for param in network.parameters():
+                param.requires_grad = False
+            num_folded += fold_batchnorm(network)
+        return num_folded
+
 
     def save_network(self, network, epoch, net_name):
-        save_filename = 'epoch_%s_net_%s.pth' % (epoch, net_name)
-        save_path = os.path.join(self.net_save_dir, save_filename)
-        torch.save(network.cpu().state_dict(), save_path)
-        if self.opts.use_gpu:
-            network.cuda()
+        save_filename = network_name(epoch, net_name)
+        self.checkpoint_writer.write(snapshot(unwrap(network).state_dict()), save_filename, rotate=False)
 
     def load_network(self, network, epoch, net_name):
-        save_filename = 'epoch_%s_net_%s.pth' % (epoch, net_name)
+        save_filename = network_name(epoch, net_name)
         save_path = os.path.join(self.net_save_dir, save_filename)
-        network.load_state_dict(torch.load(save_path))
+        network.load_state_dict(torch.load(save_path, map_location='cpu'))
 
 
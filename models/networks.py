@@ -9,6 +9,90 @@ This code was implemented based on Star-GAN pytorch implementation.
 """
 
 
+def forward_chunked(module, x, num_chunks=1):
+    # x holds num_chunks sub-batches stacked along dim 0. BatchNorm layers in training mode
+    # normalize (and update running stats with) every sub-batch separately, exactly as if the
+    # sub-batches were passed in separate calls; all other layers run once on the whole batch.
+    if num_chunks == 1:
+        return module(x)
+    if isinstance(module, nn.modules.batchnorm._BatchNorm) and module.training:
+        return torch.cat([module(chunk) for chunk in x.chunk(num_chunks, 0)], 0)
+    if isinstance(module, nn.Sequential):
+        for layer in module:
+            x = forward_chunked(layer, x, num_chunks)
+        return x
+    return module(x)
+
+
+def _float_inputs(module, inputs):
+    return tuple(x.float() for x in inputs)
+
+
+def keep_norm_fp32(network):
+    # under autocast, BatchNorm/InstanceNorm layers get fp32 inputs so their statistics,
+    # running buffers and outputs stay in fp32; the following conv casts down again.
+    # Sigmoids too: in bf16 every logit above ~7 rounds to 1.0, where BCELoss has no gradient
+    for module in network.modules():
+        if isinstance(module, (nn.modules.batchnorm._BatchNorm, nn.modules.instancenorm._InstanceNorm,
+                               nn.Sigmoid)):
+            module.register_forward_pre_hook(_float_inputs)
+    return network
+
+
+def _is_foldable_bn(module):
+    return isinstance(module, nn.modules.batchnorm._BatchNorm) and module.running_mean is not None
+
+
+def fold_conv_bn(conv, bn):
+    # the eval-mode BatchNorm after conv as a per-output-channel scale and shift of conv's weight and bias
+    with torch.no_grad():
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        shift = -bn.running_mean * scale
+        if bn.affine:
+            scale = scale * bn.weight
+            shift = shift * bn.weight + bn.bias
+        weight = conv.weight
+        if isinstance(conv, nn.ConvTranspose2d):
+            # (in, out / groups, kH, kW): output channels are along dim 1, per group
+            groups = conv.groups
+            weight.copy_((weight.view(groups, -1, weight.shape[1], *weight.shape[2:]) *
+                          scale.view(groups, 1, -1, 1, 1)).view_as(weight))
+        else:
+            weight.mul_(scale.view(-1, 1, 1, 1))
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(scale)
+        conv.bias = nn.Parameter(bias * scale + shift, requires_grad=False)
+
+
+def fold_batchnorm(network):
+    """Fold the BatchNorm2d layers of network into the preceding Conv2d/ConvTranspose2d, for inference.
+
+    Folds a conv followed by BatchNorm, or by an nn.Sequential starting with one (the U-Net layers).
+    The network is set to eval mode; the folded BatchNorm layers (and their running stats) are
+    replaced by nn.Identity, so the layer indices the forwards rely on stay the same.
+    Returns the number of folded layers.
+    """
+    network.eval()
+    num_folded = 0
+    for module in list(network.modules()):
+        if not isinstance(module, nn.Sequential):
+            continue
+        names = list(module._modules.keys())
+        for prev_name, name in zip(names[:-1], names[1:]):
+            conv = module._modules[prev_name]
+            if not isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d)):
+                continue
+            nxt = module._modules[name]
+            if _is_foldable_bn(nxt):
+                fold_conv_bn(conv, nxt)
+                module._modules[name] = nn.Identity()
+                num_folded += 1
+            elif isinstance(nxt, nn.Sequential) and len(nxt) > 0 and _is_foldable_bn(nxt[0]):
+                fold_conv_bn(conv, nxt[0])
+                nxt._modules[list(nxt._modules.keys())[0]] = nn.Identity()
+                num_folded += 1
+    return num_folded
+
+
 class ResidualBlock(nn.Module):
     """Residual Block."""
     def __init__(self, dim_in, dim_out):
@@ -56,7 +140,7 @@ class MaskGeneratorR(nn.Module):
         super(MaskGeneratorR, self).__init__()
 
         layers = []
-        curr_dim = opts.conv_dim * np.power(2,num_upsample)
+        curr_dim = opts.conv_dim * 2 ** num_upsample
         # Up-Sampling
         for i in range(num_upsample):
             layers.append(nn.ConvTranspose2d(curr_dim, curr_dim // 2, kernel_size=4, stride=2, padding=1, bias=False))
@@ -78,7 +162,7 @@ class ImageGeneratorR(nn.Module):
         super(ImageGeneratorR, self).__init__()
 
         layers = []
-        curr_dim = opts.conv_dim * np.power(2, num_upsample)
+        curr_dim = opts.conv_dim * 2 ** num_upsample
         # Up-Sampling
         for i in range(num_upsample):
             layers.append(nn.ConvTranspose2d(curr_dim, curr_dim // 2, kernel_size=4, stride=2, padding=1, bias=False))
@@ -117,7 +201,7 @@ class DiscriminatorR(nn.Module):
         # self.conv = nn.Conv2d(curr_dim, 1, kernel_size=3, stride=1, padding=1, bias=False)
 
 
-    def forward(self, x):
+    def forward(self, x, num_chunks=1):
         # h = self.model(x)
         # out_real = self.conv(h)
         out_real = self.model(x)
@@ -131,6 +215,18 @@ class DiscriminatorR(nn.Module):
 # U-Net structure
 #################################################################
 
+def get_num_conv_layers(output_size):
+    # depth of the U-Net, the innermost feature map is 4x4
+    num_conv_layers = 0
+    osize = output_size / 4
+    while (True):
+        osize = osize / 2
+        if osize < 1:
+            break
+        num_conv_layers = num_conv_layers + 1
+    return num_conv_layers
+
+
 class PartEncoderU(nn.Module):
     def __init__(self, opts):
         super(PartEncoderU, self).__init__()
@@ -143,15 +239,15 @@ class PartEncoderU(nn.Module):
 
         for i in range(self.opts.num_conv_layers):
             powers = min(3, i)
-            conv_dims_in.append(opts.conv_dim * np.power(2, powers))
-            conv_dims_out.append(opts.conv_dim * np.power(2, powers))
+            conv_dims_in.append(opts.conv_dim * 2 ** powers)
+            conv_dims_out.append(opts.conv_dim * 2 ** powers)
         conv_dims_out.append(self.opts.part_embed_dim)
 
         layer = []
 
         for i in range(self.opts.num_conv_layers + 1):
             if i == self.opts.num_conv_layers:
-                _kernel_size = np.int(self.opts.output_size / np.power(2, self.opts.num_conv_layers))
+                _kernel_size = int(self.opts.output_size / np.power(2, self.opts.num_conv_layers))
                 _stride = 1
                 _padding = 0
             else:
@@ -172,11 +268,11 @@ class PartEncoderU(nn.Module):
 
         self.model = nn.Sequential(*model)
 
-    def forward(self, x):
+    def forward(self, x, num_chunks=1):
         e = []
         out = x
         for i in range(len(self.model)):
-            out = self.model[i](out)
+            out = forward_chunked(self.model[i], out, num_chunks)
             e.append(out)
         return e
 
@@ -190,15 +286,15 @@ class MaskGeneratorU(nn.Module):
 
         for i in range(self.opts.num_conv_layers):
             powers = min(3, self.opts.num_conv_layers - 1 - i)
-            conv_dims_in.append(opts.conv_dim * np.power(2, powers) * 2)
-            conv_dims_out.append(opts.conv_dim * np.power(2, powers))
+            conv_dims_in.append(opts.conv_dim * 2 ** powers * 2)
+            conv_dims_out.append(opts.conv_dim * 2 ** powers)
         conv_dims_out.append(1)
 
         layer = []
 
         for i in range(self.opts.num_conv_layers + 1):
             if i == 0:
-                _kernel_size = np.int(self.opts.output_size / np.power(2, self.opts.num_conv_layers))
+                _kernel_size = int(self.opts.output_size / np.power(2, self.opts.num_conv_layers))
                 _stride = 1
                 _padding = 0
             else:
@@ -237,13 +333,13 @@ class MaskGeneratorU(nn.Module):
         for i, layer in enumerate(self.model):
             if i % 2 == 0:
                 # convTranspose layer
-                out = layer(out, output_size=[_output_size[i/2], _output_size[i/2]])
+                out = layer(out, output_size=[_output_size[i//2], _output_size[i//2]])
             else:
                 # activation layer
                 out = layer(out)
                 if i < (len(self.model)-1):
                     # concatenate
-                    out = torch.cat([out, parts_enc[-2 - (i-1)/2]], 1)
+                    out = torch.cat([out, parts_enc[-2 - (i-1)//2]], 1)
                 m.append(out)
         return m
 
@@ -257,14 +353,14 @@ class ImageGeneratorU(nn.Module):
 
         for i in range(self.opts.num_conv_layers):
             powers = min(3, self.opts.num_conv_layers - 1 - i)
-            conv_dims_in.append(opts.conv_dim * np.power(2, powers) * 3)
-            conv_dims_out.append(opts.conv_dim * np.power(2, powers))
+            conv_dims_in.append(opts.conv_dim * 2 ** powers * 3)
+            conv_dims_out.append(opts.conv_dim * 2 ** powers)
         conv_dims_out.append(opts.c_dim)
 
         layer = []
         for i in range(self.opts.num_conv_layers + 1):
             if i == 0:
-                _kernel_size = np.int(self.opts.output_size / np.power(2, self.opts.num_conv_layers))
+                _kernel_size = int(self.opts.output_size / np.power(2, self.opts.num_conv_layers))
                 _stride = 1
                 _padding = 0
             else:
@@ -301,13 +397,13 @@ class ImageGeneratorU(nn.Module):
         for i, layer in enumerate(self.model):
             if i % 2 == 0:
                 # convTranspose layer
-                out = layer(out, output_size=[_output_size[i/2], _output_size[i/2]])
+                out = layer(out, output_size=[_output_size[i//2], _output_size[i//2]])
             else:
                 # activation layer
                 out = layer(out)
                 if i < (len(self.model)-1):
                     # concatenate
-                    out = torch.cat([out, m[(i-1)/2]], 1)
+                    out = torch.cat([out, m[(i-1)//2]], 1)
                 g.append(out)
 
         return g
@@ -325,8 +421,8 @@ class DiscriminatorU(nn.Module):
 
         for i in range(self.opts.num_conv_layers):
             powers = min(3, i)
-            conv_dims_in.append(opts.conv_dim * np.power(2, powers))
-            conv_dims_out.append(opts.conv_dim * np.power(2, powers))
+            conv_dims_in.append(opts.conv_dim * 2 ** powers)
+            conv_dims_out.append(opts.conv_dim * 2 ** powers)
         conv_dims_out.append(1)
 
         layer = []
@@ -334,7 +430,7 @@ class DiscriminatorU(nn.Module):
         for i in range(self.opts.num_conv_layers + 1):
 
             if i == self.opts.num_conv_layers:
-                _kernel_size = np.int(self.opts.output_size / np.power(2, self.opts.num_conv_layers))
+                _kernel_size = int(self.opts.output_size / np.power(2, self.opts.num_conv_layers))
                 _stride = 1
                 _padding = 0
             else:
@@ -357,5 +453,5 @@ class DiscriminatorU(nn.Module):
         model = [layer[i] for i in range(len(layer))]
         self.model = nn.Sequential(*model)
 
-    def forward(self, x):
-        return self.model(x)
\ No newline at end of file
+    def forward(self, x, num_chunks=1):
+        return forward_chunked(self.model, x, num_chunks)
\ No newline at end of file
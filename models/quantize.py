@@ -0,0 +1,185 @@
+"""
+Post-training static int8 quantization of the U-Net generator stack for CPU inference:
+
+python -m models.quantize --db_name=celebA --dataset_root=... --output_size=128 \
+    --quant_epoch=24 --calib_triples=256 --eval_triples=256 --fp32_layers=final --quant_path=generator_int8.pt
+
+Observers are calibrated on key-patch triples of the dataset, then the BatchNorm-folded
+GeneratorPipeline (models/export.py) is converted with FX graph mode quantization. The command
+reports, against the fp32 pipeline on other triples with the same z: the mean L1 of the images
+and masks, a Frechet distance of pixel features (an FID-style statistic without an Inception
+network), the latency per batch and the size of the weights. The int8 model is saved as TorchScript.
+
+Dynamic quantization only covers Linear/recurrent layers, which these networks do not have,
+so only static quantization is done.
+"""
+import io
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from .export import GeneratorPipeline
+from utils.my_utils import prepare_data, prepare_data_cached
+
+
+def final_layers(pipeline):
+    # the last (transposed conv, Sigmoid/Tanh) blocks of the mask and image generators
+    names = []
+    for decoder_name in ['mask_generator', 'image_generator']:
+        num_layers = len(getattr(pipeline, decoder_name))
+        names += ['%s.%d' % (decoder_name, num_layers - 2), '%s.%d' % (decoder_name, num_layers - 1)]
+    return names
+
+
+def quantize_pipeline(pipeline, calibration, fp32_layers=(), backend='x86'):
+    """Static int8 quantization of a GeneratorPipeline.
+
+    calibration: list of (part1, part2, part3, z) batches the observers are run on.
+    fp32_layers: module names (e.g. from final_layers) that are kept in fp32.
+    """
+    # the quantized kernels the converted model runs with (x86 picks fbgemm or onednn per op)
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    # the uint8 -> float input conversion is not quantized
+    for name in ['patch_input'] + list(fp32_layers):
+        qconfig_mapping.set_module_name(name, None)
+
+    pipeline = pipeline.eval()
+    with torch.no_grad():
+        prepared = prepare_fx(pipeline, qconfig_mapping, calibration[0])
+        for inputs in calibration:
+            prepared(*inputs)
+        return convert_fx(prepared)
+
+
+def load_triples(dataset, index, opts):
+    # uint8 key-patch triples and input images of dataset[index], in batches of opts.batch_size
+    batches = []
+    for start in range(0, len(index) - opts.batch_size + 1, opts.batch_size):
+        batch_idx = index[start:start + opts.batch_size]
+        if opts.use_cache:
+            images, part1, part2, part3, _, _ = prepare_data_cached(dataset, batch_idx, False, opts)
+        else:
+            image_paths, bbs = dataset[batch_idx]
+            images, part1, part2, part3, _, _ = prepare_data(image_paths, bbs, False, opts)
+        batches.append([torch.from_numpy(np.ascontiguousarray(x)) for x in [part1, part2, part3, images]])
+    return batches
+
+
+def pixel_features(images, size=8):
+    # (N, C, S, S) in [-1, 1] -> (N, C * size * size) average-pooled pixels
+    return F.adaptive_avg_pool2d(images.float(), size).flatten(1).double().numpy()
+
+
+def frechet_distance(features1, features2):
+    # Frechet distance between Gaussians fitted to two feature sets, as in FID
+    from scipy import linalg
+    mu1, mu2 = features1.mean(0), features2.mean(0)
+    sigma1, sigma2 = np.cov(features1, rowvar=False), np.cov(features2, rowvar=False)
+    covmean, _ = linalg.sqrtm(sigma1.dot(sigma2), disp=False)
+    if not np.isfinite(covmean).all():
+        offset = np.eye(sigma1.shape[0]) * 1e-6
+        covmean = linalg.sqrtm((sigma1 + offset).dot(sigma2 + offset))
+    covmean = covmean.real
+    return float(((mu1 - mu2) ** 2).sum() + np.trace(sigma1) + np.trace(sigma2) - 2 * np.trace(covmean))
+
+
+def model_nbytes(module):
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell()
+
+
+def generate_all(pipeline, batches):
+    images = []
+    masks = []
+    with torch.no_grad():
+        for inputs in batches:
+            image, mask = pipeline(*inputs)
+            images.append(image)
+            masks.append(mask)
+    return torch.cat(images, 0), torch.cat(masks, 0)
+
+
+def time_batches(pipeline, batches, iters):
+    with torch.no_grad():
+        pipeline(*batches[0])
+        start = time.time()
+        for i in range(iters):
+            pipeline(*batches[i % len(batches)])
+    return (time.time() - start) / iters
+
+
+if __name__ == '__main__':
+    from options.options import Options
+    from data.database import Dataset
+    from models.inference import KeyPatchGanGenerator
+
+    parser = Options().parser
+    parser.add_argument('--quant_epoch', type=int, required=True)
+    parser.add_argument('--quant_path', default='')
+    parser.add_argument('--calib_triples', type=int, default=256)
+    parser.add_argument('--eval_triples', type=int, default=256)
+    # 'final' (the Sigmoid/Tanh output blocks), 'none' or comma separated GeneratorPipeline module names
+    parser.add_argument('--fp32_layers', default='final')
+    parser.add_argument('--quant_backend', default='x86', choices=['x86', 'fbgemm', 'qnnpack'])
+    parser.add_argument('--quant_iters', type=int, default=10)
+    opts = parser.parse_args()
+    opts.gpu_id = int(opts.gpu_id)
+    opts.use_gpu = False
+    opts.precision = 'fp32'
+    opts.embed_cache_mb = 0
+
+    generator = KeyPatchGanGenerator()
+    generator.initialize(opts, epoch=opts.quant_epoch)
+    pipeline = GeneratorPipeline(generator.net_part_encoder, generator.net_mask_generator,
+                                 generator.net_generator).eval()
+
+    dataset = Dataset()
+    dataset.initialize(opts)
+    rng = np.random.RandomState(opts.random_seed)
+    index = rng.permutation(len(dataset))
+    calib_batches = load_triples(dataset, index[:opts.calib_triples], opts)
+    eval_batches = load_triples(dataset, index[opts.calib_triples:opts.calib_triples + opts.eval_triples], opts)
+    # fixed z per batch, the same for both models
+    calibration = [batch[:3] + [torch.from_numpy(rng.uniform(-1, 1, (opts.batch_size, opts.z_dim, 1, 1))
+                                                 .astype(np.float32))] for batch in calib_batches]
+    evaluation = [batch[:3] + [torch.from_numpy(rng.uniform(-1, 1, (opts.batch_size, opts.z_dim, 1, 1))
+                                                .astype(np.float32))] for batch in eval_batches]
+    if not calibration or not evaluation:
+        raise ValueError('calib_triples and eval_triples need at least batch_size triples each')
+
+    if opts.fp32_layers == 'final':
+        fp32_layers = final_layers(pipeline)
+    elif opts.fp32_layers == 'none':
+        fp32_layers = []
+    else:
+        fp32_layers = opts.fp32_layers.split(',')
+    quantized = quantize_pipeline(pipeline, calibration, fp32_layers, opts.quant_backend)
+    print('fp32 layers: %s' % (', '.join(fp32_layers) or 'none'))
+
+    images, masks = generate_all(pipeline, evaluation)
+    q_images, q_masks = generate_all(quantized, evaluation)
+    real_images = torch.cat([batch[3] for batch in eval_batches], 0).permute(0, 3, 1, 2).float() / 127.5 - 1.0
+    real_features = pixel_features(real_images)
+    features, q_features = pixel_features(images), pixel_features(q_images)
+
+    print('%d calibration / %d evaluation triples' % (len(calibration) * opts.batch_size, len(images)))
+    print('L1 to fp32: image %.4f, mask %.4f' % ((q_images - images).abs().mean().item(),
+                                                 (q_masks - masks).abs().mean().item()))
+    print('pixel-feature Frechet distance: fp32-int8 %.4f, real-fp32 %.4f, real-int8 %.4f'
+          % (frechet_distance(features, q_features), frechet_distance(real_features, features),
+             frechet_distance(real_features, q_features)))
+    print('per batch of %d: fp32 %.4f sec, int8 %.4f sec' % (opts.batch_size,
+                                                            time_batches(pipeline, evaluation, opts.quant_iters),
+                                                            time_batches(quantized, evaluation, opts.quant_iters)))
+    print('weights: fp32 %.1f MB, int8 %.1f MB' % (model_nbytes(pipeline) / 1e6, model_nbytes(quantized) / 1e6))
+
+    if opts.quant_path:
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(quantized, evaluation[0]))
+        torch.jit.save(traced, opts.quant_path)
+        print('Saved to %s' % opts.quant_path)
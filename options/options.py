@@ -2,6 +2,24 @@ import argparse
 import os
 import numpy as np
 
+
+def str2bool(v):
+    if isinstance(v, bool):
+        return v
+    if v.lower() in ('yes', 'true', 't', 'y', '1'):
+        return True
+    if v.lower() in ('no', 'false', 'f', 'n', '0'):
+        return False
+    raise argparse.ArgumentTypeError('Boolean value expected.')
+
+
+def positive_int(v):
+    v = int(v)
+    if v < 1:
+        raise argparse.ArgumentTypeError('Positive integer expected.')
+    return v
+
+
 class Options():
     def __init__(self):
         self.parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -14,6 +32,7 @@ class Options():
         self.parser.add_argument('--epoch',         type=int, default=25)
         self.parser.add_argument('--learning_rate', type=float, default=0.0002)
         self.parser.add_argument('--beta1',         type=float, default=0.5)
+        self.parser.add_argument('--d_steps_per_g', type=positive_int, default=2)
         self.parser.add_argument('--batch_size',    type=int, default=64)
         self.parser.add_argument('--image_size',    type=int, default=108)
         self.parser.add_argument('--output_size',   type=int, default=64)
@@ -26,41 +45,102 @@ class Options():
         self.parser.add_argument('--num_train_imgs', type=int, default=np.inf)
         self.parser.add_argument('--is_train',      default=True)
         self.parser.add_argument('--is_crop',       default=True)
-        self.parser.add_argument('--cont_train', default=False)
-        self.parser.add_argument('--start_epoch', default=0)
+        # resume from the latest full checkpoint in net_dir (exact, mid-epoch), or if there is
+        # none, from the per-network weights of start_epoch
+        self.parser.add_argument('--cont_train', type=str2bool, default=False)
+        self.parser.add_argument('--start_epoch', type=int, default=0)
         self.parser.add_argument('--model_structure', default='unet')
         self.parser.add_argument('--res_n_repeat', type=int, default=4)
         self.parser.add_argument('--res_n_downsample', type=int, default=3)
         self.parser.add_argument('--res_n_upsample', type=int, default=3)
+        # interpolation of the key patches, in prepare_data and the dataset cache (bicubic is closest to PIL)
+        self.parser.add_argument('--part_interp', default='bicubic', choices=['bilinear', 'bicubic', 'nearest'])
         # self.parser.add_argument('--model_structure', default='unet')
+        # run the part encoder once on the three stacked key parts instead of three times
+        self.parser.add_argument('--fuse_part_encoder', type=str2bool, default=True)
+        # also train D to reject gen-part/real-bg and real-part/gen-bg composites
+        self.parser.add_argument('--d_extra_composites', type=str2bool, default=False)
+        # autocast the networks to bf16/fp16 (norm layers and the GAN losses stay fp32, fp16 uses loss scaling)
+        self.parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'fp16'])
 
 
         ### OTHER OPTIONS ###
-        self.parser.add_argument('--use_gpu', default=True)
-        self.parser.add_argument('--use_multigpu', default=True)
+        # both fall back to False when CUDA is not available
+        self.parser.add_argument('--use_gpu', type=str2bool, default=True)
+        self.parser.add_argument('--use_multigpu', type=str2bool, default=True)
         self.parser.add_argument('--gpu_id', default=0)
-        self.parser.add_argument('--use_visdom', default=True)
+        # data-parallel training with one process per rank (torch.distributed): main.py starts
+        # nproc_per_node processes, or run it under torchrun. batch_size is per process
+        self.parser.add_argument('--distributed', type=str2bool, default=False)
+        self.parser.add_argument('--nproc_per_node', type=int, default=1)
+        self.parser.add_argument('--nnodes', type=int, default=1)
+        self.parser.add_argument('--node_rank', type=int, default=0)
+        self.parser.add_argument('--dist_backend', default='gloo')
+        self.parser.add_argument('--dist_url', default='tcp://127.0.0.1:23456')
+        # BatchNorm statistics over the batches of all processes
+        self.parser.add_argument('--sync_bn', type=str2bool, default=True)
+        # CPU cores of the training threads and the loader workers: 'none' (no pinning), 'pin'
+        # (loader_cores/intra_threads below) or 'autotune' (measured once per machine, kept in resource_file)
+        self.parser.add_argument('--cpu_layout', default='none', choices=['none', 'pin', 'autotune'])
+        self.parser.add_argument('--loader_cores', type=int, default=-1)       # -1: one per worker, at most half
+        self.parser.add_argument('--intra_threads', type=int, default=0)       # 0: one per training core
+        self.parser.add_argument('--interop_threads', type=int, default=1)
+        self.parser.add_argument('--autotune_iters', type=int, default=8)
+        self.parser.add_argument('--resource_file', default='~/.cache/keypatchgan/cpu_layout.json')
+        self.parser.add_argument('--use_visdom', type=str2bool, default=True)
         self.parser.add_argument('--visdom_port', type=int, default=8097)
-        self.parser.add_argument('--use_tensorboard', default=True)
+        self.parser.add_argument('--use_tensorboard', type=str2bool, default=True)
         self.parser.add_argument('--tb_log_path', default='logs')
-        self.parser.add_argument('--random_seed', default=1004)
+        self.parser.add_argument('--random_seed', type=int, default=1004)
+        # per-stage timeline (profile_dir/timeline.json) and rolling percentiles over profile_window calls
+        self.parser.add_argument('--profile', type=str2bool, default=False)
+        self.parser.add_argument('--profile_dir', default='profile')
+        self.parser.add_argument('--profile_window', type=int, default=1000)
+        # print import and initialization time per component after the first logged iteration
+        self.parser.add_argument('--profile_startup', type=str2bool, default=False)
 
         self.parser.add_argument('--num_tests',     type=int, default=128)
         self.parser.add_argument('--num_samples',   type=int, default=128)
         self.parser.add_argument('--sample_dir',    default='results/samples')
         self.parser.add_argument('--test_dir',      default='results/test')
         self.parser.add_argument('--net_dir',      default='nets')
+        # sample/test grids are encoded and written on background threads; when image_queue
+        # grids are pending, new ones are dropped. image_compression: png zlib level / webp effort
+        self.parser.add_argument('--image_format', default='png', choices=['png', 'webp', 'bmp'])
+        self.parser.add_argument('--image_compression', type=int, default=1)
+        self.parser.add_argument('--image_writer_threads', type=int, default=2)
+        self.parser.add_argument('--image_queue', type=int, default=4)
+        # maximum batch size of the standalone generator (models/inference.py)
+        self.parser.add_argument('--infer_batch_size', type=int, default=64)
+        # fold its BatchNorm layers into the preceding (transposed) convs
+        self.parser.add_argument('--fold_bn', type=str2bool, default=True)
+        # memory budget of its cache of part embeddings and mask pyramids (0 disables it)
+        self.parser.add_argument('--embed_cache_mb', type=float, default=256)
+        # activation memory per image generator chunk of KeyPatchGanGenerator.sample_many
+        self.parser.add_argument('--infer_memory_mb', type=float, default=1024)
+        # full checkpoints (nets + optimizers) every save_every iterations (0: end of epoch only)
+        self.parser.add_argument('--save_every',    type=int, default=0)
+        self.parser.add_argument('--keep_checkpoints', type=int, default=3)
 
 
         ### DATABASE OPTIONS ###
         self.parser.add_argument('--db_name', default='celebA')
         # self.parser.add_argument('--db_name', default='compcar_256')
         self.parser.add_argument('--dataset_root', default='/home/sangdoo/work/dataset')
+        # cropped/resized images, key patches and gt masks are written once to a uint8 memmap
+        self.parser.add_argument('--use_cache', type=str2bool, default=False)
+        self.parser.add_argument('--cache_dir', default='cache')
+        # batches are built by background workers, prefetch_batches per worker are queued ahead
+        self.parser.add_argument('--num_workers', type=int, default=4)
+        self.parser.add_argument('--prefetch_batches', type=int, default=2)
+        # how mismatched images are drawn: 'replace' (uniform with replacement) or
+        # 'unique' (no image is used as a negative twice within an epoch)
+        self.parser.add_argument('--shuff_sampling', default='replace', choices=['replace', 'unique'])
 
     def parse(self):
         self.opt = self.parser.parse_args()
         args = vars(self.opt)
-        self.opt.gpu_id = np.int(self.opt.gpu_id)
+        self.opt.gpu_id = int(self.opt.gpu_id)
         for k,v in sorted(args.items()):
             print('%s: %s' %(str(k), str(v)))
         return self.opt
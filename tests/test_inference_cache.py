@@ -0,0 +1,34 @@
+import os
+import sys
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from options.options import Options
+from models.inference import KeyPatchGanGenerator
+
+
+def make_generator(embed_cache_mb):
+    opts = Options().parser.parse_args(['--use_gpu=False', '--output_size=64',
+                                        '--embed_cache_mb=%s' % embed_cache_mb])
+    opts.gpu_id = int(opts.gpu_id)
+    torch.manual_seed(0)
+    generator = KeyPatchGanGenerator()
+    generator.initialize(opts, epoch=None)
+    return generator
+
+
+def test_reused_parts_under_eviction_pressure():
+    # a patch cache of a few entries: the hits of the second call are evicted by its own new patches
+    cached = make_generator(4)
+    uncached = make_generator(0)
+    parts = [torch.randint(0, 256, (8, 64, 64, 3), dtype=torch.uint8) for _ in range(5)]
+    z = torch.rand(8, 128, 1, 1) * 2.0 - 1.0
+
+    cached.generate(parts[0], parts[1], parts[2], z)
+    assert 0 < len(cached.patch_cache) < 8
+    image, mask = cached.generate(parts[3], parts[4], parts[2], z)
+    assert cached.patch_cache.hits > 0
+
+    ref_image, ref_mask = uncached.generate(parts[3], parts[4], parts[2], z)
+    assert torch.allclose(image, ref_image, atol=1e-5)
+    assert torch.allclose(mask, ref_mask, atol=1e-5)
@@ -0,0 +1,72 @@
+import queue
+import threading
+
+
+class BackgroundWriter():
+    # Base of the checkpoint, image and event file writers: items put on a bounded queue are
+    # passed to process() on daemon threads, so the training loop does not wait for the disk.
+    # An exception in process() is kept and raised by the next put/check_error/wait/close.
+    error_message = 'Background write failed'
+
+    def __init__(self):
+        self.threads = []
+
+    def start(self, max_pending, num_threads=1, idle_secs=None):
+        # with idle_secs, idle() is called when no item arrived for that many seconds
+        self.error = None
+        self.idle_secs = idle_secs
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.threads = []
+        for _ in range(num_threads):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, item, block=True):
+        # raises queue.Full if block is False and max_pending items are waiting
+        self.check_error()
+        self.queue.put(item, block)
+
+    def process(self, item):
+        raise NotImplementedError
+
+    def idle(self):
+        pass
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.idle_secs)
+            except queue.Empty:
+                try:
+                    self.idle()
+                except Exception as e:
+                    self.error = e
+                continue
+            try:
+                if item is None:
+                    break
+                self.process(item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('%s: %s' % (self.error_message, error))
+
+    def wait(self):
+        # blocks until everything queued so far is processed
+        self.queue.join()
+        self.check_error()
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.check_error()
@@ -0,0 +1,113 @@
+import os
+import re
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .background import BackgroundWriter
+
+
+CHECKPOINT_PATTERN = re.compile(r'^ckpt_e(\d+)_i(\d+)\.pth$')
+
+
+def save_dir_name(opts):
+    # per-configuration sub directory of sample_dir/test_dir/net_dir
+    return str(opts.model_structure) + '_o' + str(opts.output_size) + '_b' + str(opts.batch_size) + \
+        '_df' + str(opts.conv_dim) + '_epch' + str(opts.epoch)
+
+
+def network_name(epoch, net_name):
+    return 'epoch_%s_net_%s.pth' % (epoch, net_name)
+
+
+def checkpoint_name(epoch, iteration):
+    return 'ckpt_e%03d_i%06d.pth' % (epoch, iteration)
+
+
+def list_checkpoints(save_dir):
+    # full training checkpoints in save_dir as (epoch, iteration, filename), oldest first
+    if not os.path.isdir(save_dir):
+        return []
+    ckpts = []
+    for filename in os.listdir(save_dir):
+        match = CHECKPOINT_PATTERN.match(filename)
+        if match:
+            ckpts.append((int(match.group(1)), int(match.group(2)), filename))
+    return sorted(ckpts)
+
+
+def unwrap(network):
+    # state dicts are always saved without the (Distributed)DataParallel 'module.' prefix
+    if isinstance(network, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        return network.module
+    return network
+
+
+def snapshot(state):
+    # detached CPU copy of a (nested) state dict; the live modules stay where they are
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, snapshot(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+def get_rng_state():
+    # numpy/torch RNG states as tensors, so checkpoints stay loadable with weights_only
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'np_rng_keys': torch.from_numpy(keys.astype(np.int64)),
+             'np_rng_pos': int(pos),
+             'np_rng_has_gauss': int(has_gauss),
+             'np_rng_cached_gaussian': float(cached_gaussian),
+             'torch_rng_state': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda_rng_state'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    np.random.set_state(('MT19937', state['np_rng_keys'].numpy().astype(np.uint32), state['np_rng_pos'],
+                         state['np_rng_has_gauss'], state['np_rng_cached_gaussian']))
+    torch.set_rng_state(state['torch_rng_state'])
+    if 'cuda_rng_state' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda_rng_state'])
+
+
+class CheckpointWriter(BackgroundWriter):
+    error_message = 'Writing checkpoint failed'
+
+    def __init__(self):
+        super(CheckpointWriter, self).__init__()
+        self.save_dir = None
+
+    def initialize(self, save_dir, keep_last=3, max_pending=2):
+        self.save_dir = save_dir
+        self.keep_last = keep_last
+        # bounded, so a slow disk cannot pile up snapshots in host memory
+        self.start(max_pending)
+
+    def write(self, state, filename, rotate=True):
+        """Queue a snapshot for writing; `state` must not be modified afterwards."""
+        self.write_files([(state, filename)], rotate)
+
+    def write_files(self, files, rotate=True):
+        # (state, filename) snapshots written as one job, so they take a single queue slot
+        self.put((files, rotate))
+
+    def process(self, item):
+        files, rotate = item
+        for state, filename in files:
+            save_path = os.path.join(self.save_dir, filename)
+            tmp_path = save_path + '.tmp'
+            torch.save(state, tmp_path)
+            os.rename(tmp_path, save_path)
+        if rotate:
+            self.rotate()
+
+    def rotate(self):
+        if self.keep_last <= 0:
+            return
+        for _, _, filename in list_checkpoints(self.save_dir)[:-self.keep_last]:
+            os.remove(os.path.join(self.save_dir, filename))
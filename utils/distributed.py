@@ -0,0 +1,189 @@
+import os
+import sys
+import time
+import signal
+import subprocess
+import multiprocessing
+import contextlib
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+
+def launch(opts):
+    """Start the nproc_per_node training processes of this node and wait for them.
+
+    Returns True in the launching process (which does not train itself), False in the
+    training processes and when they were started by an external launcher such as torchrun.
+    """
+    if not opts.distributed or 'RANK' in os.environ:
+        return False
+    world_size = opts.nnodes * opts.nproc_per_node
+    # the cores of the node are split between its processes
+    num_threads = os.environ.get('OMP_NUM_THREADS', str(max(1, multiprocessing.cpu_count() // opts.nproc_per_node)))
+
+    procs = []
+    for local_rank in range(opts.nproc_per_node):
+        env = dict(os.environ)
+        env.update({'RANK': str(opts.node_rank * opts.nproc_per_node + local_rank),
+                    'LOCAL_RANK': str(local_rank),
+                    'WORLD_SIZE': str(world_size),
+                    'OMP_NUM_THREADS': num_threads})
+        procs.append(subprocess.Popen([sys.executable] + sys.argv, env=env))
+
+    # if one process fails, the others would wait for it forever in the next collective
+    try:
+        while procs:
+            for proc in list(procs):
+                code = proc.poll()
+                if code is None:
+                    continue
+                procs.remove(proc)
+                if code != 0:
+                    raise RuntimeError('Training process %d exited with code %d' % (proc.pid, code))
+            time.sleep(1)
+    finally:
+        for proc in procs:
+            proc.send_signal(signal.SIGTERM)
+        for proc in procs:
+            proc.wait()
+    return True
+
+
+def init_distributed(opts):
+    # sets opts.rank, opts.local_rank and opts.world_size (0, 0, 1 without --distributed)
+    opts.rank = 0
+    opts.local_rank = 0
+    opts.world_size = 1
+    if not opts.distributed:
+        return
+    if opts.use_gpu and opts.use_multigpu and torch.cuda.is_available():
+        raise ValueError('--distributed replaces --use_multigpu, set --use_multigpu=False')
+
+    opts.rank = int(os.environ['RANK'])
+    opts.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    opts.world_size = int(os.environ['WORLD_SIZE'])
+    init_method = 'env://' if 'MASTER_ADDR' in os.environ else opts.dist_url
+    dist.init_process_group(opts.dist_backend, init_method=init_method,
+                            rank=opts.rank, world_size=opts.world_size)
+    if 'OMP_NUM_THREADS' in os.environ:
+        torch.set_num_threads(int(os.environ['OMP_NUM_THREADS']))
+    if opts.world_size > 1 and opts.profile:
+        opts.profile_dir = os.path.join(opts.profile_dir, 'rank%d' % opts.rank)
+
+
+def cleanup_distributed(opts):
+    if opts.distributed and dist.is_initialized():
+        dist.barrier()
+        dist.destroy_process_group()
+
+
+def is_main_process(opts):
+    return getattr(opts, 'rank', 0) == 0
+
+
+def barrier(opts):
+    # no-op without an initialized process group
+    if getattr(opts, 'distributed', False) and dist.is_initialized():
+        dist.barrier()
+
+
+def all_reduce_mean(tensor, opts):
+    if opts.distributed and opts.world_size > 1:
+        dist.all_reduce(tensor)
+        tensor /= opts.world_size
+    return tensor
+
+
+@contextlib.contextmanager
+def no_grad_sync(network):
+    # gradients computed inside are not all-reduced (for gradients that are discarded anyway)
+    if isinstance(network, nn.parallel.DistributedDataParallel):
+        with network.no_sync():
+            yield
+    else:
+        yield
+
+
+class SyncBatchNormFunction(torch.autograd.Function):
+    # batch norm with statistics over the batches of all processes; works with gloo on CPU
+
+    @staticmethod
+    def forward(ctx, input, weight, bias, running_mean, running_var, eps, momentum, process_group):
+        dims = [0] + list(range(2, input.dim()))
+        count = input.numel() // input.shape[1]
+        stats = torch.cat([input.sum(dims), (input * input).sum(dims),
+                           torch.full([1], float(count), dtype=input.dtype, device=input.device)])
+        dist.all_reduce(stats, group=process_group)
+        num_channels = input.shape[1]
+        total = stats[-1]
+        mean = stats[:num_channels] / total
+        var = (stats[num_channels:2 * num_channels] / total - mean * mean).clamp_(min=0)
+        invstd = torch.rsqrt(var + eps)
+
+        if running_mean is not None:
+            running_mean.mul_(1 - momentum).add_(mean.detach() * momentum)
+            running_var.mul_(1 - momentum).add_(var.detach() * (total / (total - 1).clamp(min=1)) * momentum)
+
+        shape = [1, -1] + [1] * (input.dim() - 2)
+        xhat = (input - mean.view(shape)) * invstd.view(shape)
+        ctx.save_for_backward(xhat, weight, invstd, total)
+        ctx.process_group = process_group
+        return xhat * weight.view(shape) + bias.view(shape)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        xhat, weight, invstd, total = ctx.saved_tensors
+        dims = [0] + list(range(2, grad_output.dim()))
+        shape = [1, -1] + [1] * (grad_output.dim() - 2)
+        sum_dy = grad_output.sum(dims)
+        sum_dy_xhat = (grad_output * xhat).sum(dims)
+
+        # parameter gradients stay local, DDP averages them like all other gradients
+        grad_weight = sum_dy_xhat
+        grad_bias = sum_dy
+        stats = torch.cat([sum_dy, sum_dy_xhat])
+        dist.all_reduce(stats, group=ctx.process_group)
+        mean_dy, mean_dy_xhat = (stats / total).chunk(2)
+        grad_input = (grad_output - mean_dy.view(shape) - xhat * mean_dy_xhat.view(shape)) * \
+            (weight * invstd).view(shape)
+        return grad_input, grad_weight, grad_bias, None, None, None, None, None
+
+
+class SyncBatchNorm(nn.modules.batchnorm._BatchNorm):
+    # Same parameters and buffers as BatchNorm2d. Training mode normalizes with the statistics
+    # of the whole distributed batch; eval mode and single process runs are plain batch norm.
+    def __init__(self, num_features, eps=1e-5, momentum=0.1, affine=True, track_running_stats=True,
+                 process_group=None):
+        super(SyncBatchNorm, self).__init__(num_features, eps, momentum, affine, track_running_stats)
+        self.process_group = process_group
+
+    def _check_input_dim(self, input):
+        if input.dim() < 2:
+            raise ValueError('expected at least 2D input (got %dD input)' % input.dim())
+
+    def forward(self, input):
+        need_sync = self.training and self.affine and dist.is_available() and dist.is_initialized() and \
+            dist.get_world_size(self.process_group) > 1
+        if not need_sync or self.momentum is None:
+            return super(SyncBatchNorm, self).forward(input)
+        if self.track_running_stats:
+            self.num_batches_tracked.add_(1)
+        return SyncBatchNormFunction.apply(input, self.weight, self.bias,
+                                           self.running_mean if self.track_running_stats else None,
+                                           self.running_var if self.track_running_stats else None,
+                                           self.eps, self.momentum, self.process_group)
+
+
+def convert_sync_batchnorm(module, process_group=None):
+    # replaces every BatchNorm layer, keeping its parameters, buffers and forward pre-hooks
+    if isinstance(module, nn.modules.batchnorm._BatchNorm) and not isinstance(module, SyncBatchNorm):
+        sync_bn = SyncBatchNorm(module.num_features, module.eps, module.momentum, module.affine,
+                                module.track_running_stats, process_group)
+        sync_bn.load_state_dict(module.state_dict())
+        sync_bn.train(module.training)
+        sync_bn._forward_pre_hooks.update(module._forward_pre_hooks)
+        return sync_bn
+    for name, child in module.named_children():
+        module._modules[name] = convert_sync_batchnorm(child, process_group)
+    return module
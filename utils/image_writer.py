@@ -0,0 +1,59 @@
+import queue
+import torch
+from PIL import Image, features
+
+from .background import BackgroundWriter
+
+
+IMAGE_EXTENSIONS = {'png': 'png', 'webp': 'webp', 'bmp': 'bmp'}
+
+
+def make_grid(rows):
+    """Tile rows of image batches into one (R*H, N*W, 3) uint8 array.
+
+    rows: list of R (N, C, H, W) tensors in [0, 1], C is 1 or 3. Same rounding as ToPILImage.
+    """
+    rows = [row.expand(-1, 3, -1, -1) if row.shape[1] == 1 else row for row in rows]
+    grid = torch.stack(rows)
+    num_rows, num_cols, c_dim, height, width = grid.shape
+    grid = grid.permute(0, 3, 1, 4, 2).reshape(num_rows * height, num_cols * width, c_dim)
+    return grid.clamp(0, 1).mul(255).byte().cpu().numpy()
+
+
+class ImageWriter(BackgroundWriter):
+    # Encodes and writes image grids on background threads. The queue is bounded; when it is
+    # full the grid is dropped instead of blocking the training loop.
+    error_message = 'Writing image failed'
+
+    def initialize(self, image_format='png', compression=1, num_threads=2, max_pending=4):
+        if image_format == 'webp' and not features.check('webp'):
+            print('PIL was built without WebP support, writing png instead')
+            image_format = 'png'
+        self.image_format = image_format
+        self.compression = compression
+        self.num_dropped = 0
+        self.start(max_pending, num_threads)
+
+    def extension(self):
+        return IMAGE_EXTENSIONS[self.image_format]
+
+    def write(self, grid, save_path):
+        # grid: (H, W, 3) uint8 array; returns False if it was dropped
+        try:
+            self.put((grid, save_path), block=False)
+            return True
+        except queue.Full:
+            self.num_dropped += 1
+            print('Image writer is busy, dropped %s' % save_path)
+            return False
+
+    def process(self, item):
+        grid, save_path = item
+        image = Image.fromarray(grid)
+        if self.image_format == 'png':
+            image.save(save_path, format='PNG', compress_level=self.compression)
+        elif self.image_format == 'webp':
+            # lossless, compression is the encoder effort (0: fastest .. 6)
+            image.save(save_path, format='WEBP', lossless=True, method=min(self.compression, 6))
+        else:
+            image.save(save_path, format='BMP')
@@ -1,71 +1,48 @@
 # Code referenced from https://gist.github.com/gyglim/1f8dfb1b5c82627ae3efcfbbadb9f514
-import tensorflow as tf
+# Event files are written by utils/tfevents.py, TensorFlow is not needed
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
-import scipy.misc 
-try:
-    from StringIO import StringIO  # Python 2.7
-except ImportError:
-    from io import BytesIO         # Python 3.5+
+
+from .tfevents import EventFileWriter, scalar_value, image_value, histogram_value, encode_png_batch, to_uint8
 
 
 class Logger(object):
-    
-    def __init__(self, log_dir):
+
+    def __init__(self, log_dir, flush_secs=10):
         """Create a summary writer logging to log_dir."""
-        self.writer = tf.summary.FileWriter(log_dir)
+        self.writer = EventFileWriter(log_dir, flush_secs=flush_secs)
+        self.pool = None
 
     def scalar_summary(self, tag, value, step):
         """Log a scalar variable."""
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value)])
-        self.writer.add_summary(summary, step)
+        self.writer.add_summary([scalar_value(tag, value)], step)
 
     def image_summary(self, tag, images, step):
-        """Log a list of images."""
+        """Log a list of images (H, W[, C]); non-uint8 images are scaled to [0, 255] per image."""
+        if self.pool is None:
+            self.pool = ThreadPool(min(4, multiprocessing.cpu_count()))
 
-        img_summaries = []
-        for i, img in enumerate(images):
-            # Write the image to a string
-            try:
-                s = StringIO()
-            except:
-                s = BytesIO()
-            scipy.misc.toimage(img).save(s, format="png")
+        # all images are PNG-encoded in one batch
+        images = to_uint8(np.stack([np.asarray(img) for img in images]))
+        encoded = encode_png_batch(images, pool=self.pool)
+        height, width = images.shape[1:3]
+        channels = images.shape[3] if images.ndim == 4 else 1
 
-            # Create an Image object
-            img_sum = tf.Summary.Image(encoded_image_string=s.getvalue(),
-                                       height=img.shape[0],
-                                       width=img.shape[1])
-            # Create a Summary value
-            img_summaries.append(tf.Summary.Value(tag='%s/%d' % (tag, i), image=img_sum))
+        img_summaries = [image_value('%s/%d' % (tag, i), png, height, width, channels)
+                         for i, png in enumerate(encoded)]
+        self.writer.add_summary(img_summaries, step)
 
-        # Create and write Summary
-        summary = tf.Summary(value=img_summaries)
-        self.writer.add_summary(summary, step)
-        
     def histo_summary(self, tag, values, step, bins=1000):
         """Log a histogram of the tensor of values."""
+        self.writer.add_summary([histogram_value(tag, values, bins)], step)
+        self.writer.flush()
 
-        # Create a histogram using numpy
-        counts, bin_edges = np.histogram(values, bins=bins)
-
-        # Fill the fields of the histogram proto
-        hist = tf.HistogramProto()
-        hist.min = float(np.min(values))
-        hist.max = float(np.max(values))
-        hist.num = int(np.prod(values.shape))
-        hist.sum = float(np.sum(values))
-        hist.sum_squares = float(np.sum(values**2))
-
-        # Drop the start of the first bin
-        bin_edges = bin_edges[1:]
-
-        # Add bin edges and counts
-        for edge in bin_edges:
-            hist.bucket_limit.append(edge)
-        for c in counts:
-            hist.bucket.append(c)
+    def flush(self):
+        self.writer.flush()
 
-        # Create and write Summary
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, histo=hist)])
-        self.writer.add_summary(summary, step)
-        self.writer.flush()
\ No newline at end of file
+    def close(self):
+        self.writer.close()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
@@ -7,26 +7,87 @@ import random
 import numpy as np
 from PIL import Image
 import torch
-import torchvision.transforms as transforms
+import torch.nn.functional as F
 
 
 def prepare_data(image_paths, bbs, is_flip, opts):
-    input_images = [get_image(image_paths[i], opts.image_size, opts.output_size, opts.is_crop, is_flip) for
-                          i in range(opts.batch_size)]
-    p1xywh = bbs[np.arange(opts.batch_size), 0]
-    p2xywh = bbs[np.arange(opts.batch_size), 1]
-    p3xywh = bbs[np.arange(opts.batch_size), 2]
-    gt_masks = [set_mask(p1xywh, p2xywh, p3xywh, i, opts.output_size) for i in range(opts.batch_size)]
-    part1_images = [get_part_image(input_images[i], p1xywh[i], output_size=opts.output_size)
-                          for i in range(opts.batch_size)]
-    part2_images = [get_part_image(input_images[i], p2xywh[i], output_size=opts.output_size)
-                          for i in range(opts.batch_size)]
-    part3_images = [get_part_image(input_images[i], p3xywh[i], output_size=opts.output_size)
-                          for i in range(opts.batch_size)]
+    input_images = np.stack([np.asarray(get_image(image_paths[i], opts.image_size, opts.output_size, opts.is_crop, is_flip))
+                             for i in range(opts.batch_size)])
+    bbs = bbs[:opts.batch_size]
+    gt_masks = set_masks(bbs, opts.output_size).numpy()
+    images = torch.from_numpy(input_images).permute(0, 3, 1, 2).float()
+    parts = extract_parts(images, bbs, opts.output_size, mode=opts.part_interp)
+    parts = parts.round_().clamp_(0, 255).byte().permute(0, 1, 3, 4, 2).numpy()
+    part1_images = np.ascontiguousarray(parts[:, 0])
+    part2_images = np.ascontiguousarray(parts[:, 1])
+    part3_images = np.ascontiguousarray(parts[:, 2])
     z = torch.rand([opts.batch_size, opts.z_dim, 1, 1]) * 2.0 - 1.0
 
     return input_images, part1_images, part2_images, part3_images, gt_masks, z
 
+def extract_parts(images, bbs, output_size, mode='bilinear'):
+    # crop + resize of all key patches in one grid_sample call
+    # images: (B, C, H, W) float tensor, bbs: (B, P, 4) xywh -> (B, P, C, output_size, output_size)
+    num_imgs, c_dim, height, width = images.shape
+    bbs = torch.as_tensor(np.asarray(bbs), dtype=images.dtype, device=images.device)
+    num_parts = bbs.shape[1]
+    x, y, w, h = bbs.unbind(-1)
+
+    # maps output pixel centers onto the pixel centers of the box [x, x+w) x [y, y+h)
+    theta = torch.zeros(num_imgs * num_parts, 2, 3, dtype=images.dtype, device=images.device)
+    theta[:, 0, 0] = (w / width).reshape(-1)
+    theta[:, 0, 2] = ((2 * x + w) / width - 1).reshape(-1)
+    theta[:, 1, 1] = (h / height).reshape(-1)
+    theta[:, 1, 2] = ((2 * y + h) / height - 1).reshape(-1)
+    grid = F.affine_grid(theta, [num_imgs * num_parts, c_dim, output_size, output_size], align_corners=False)
+
+    # the P grids of an image are stacked along the height so the image batch is not replicated
+    grid = grid.view(num_imgs, num_parts * output_size, output_size, 2)
+    parts = F.grid_sample(images, grid, mode=mode, padding_mode='border', align_corners=False)
+    parts = parts.view(num_imgs, c_dim, num_parts, output_size, output_size)
+    return parts.transpose(1, 2)
+
+def set_masks(bbs, output_size):
+    # union of the part boxes for a whole batch: bbs (B, P, 4) xywh -> (B, output_size, output_size) uint8
+    bbs = torch.as_tensor(np.asarray(bbs)).long()
+    x, y, w, h = bbs.unbind(-1)
+    grid = torch.arange(output_size)
+    rows = (grid >= y.unsqueeze(-1)) & (grid < (y + h).unsqueeze(-1))
+    cols = (grid >= x.unsqueeze(-1)) & (grid < (x + w).unsqueeze(-1))
+    return (rows.unsqueeze(-1) & cols.unsqueeze(-2)).any(1).byte()
+
+def prepare_data_cached(dataset, index, is_flip, opts):
+    # same batch as prepare_data, sliced from the preprocessed dataset cache as uint8 arrays
+    index = index[:opts.batch_size]
+    input_images, part1_images, part2_images, part3_images, gt_masks = dataset.get_batch(index, is_flip)
+    z = torch.rand([opts.batch_size, opts.z_dim, 1, 1]) * 2.0 - 1.0
+
+    return input_images, part1_images, part2_images, part3_images, gt_masks, z
+
+def to_batch_tensor(data):
+    # stack lists of PIL images / per-sample tensors into one batch tensor without copying arrays
+    if torch.is_tensor(data):
+        return data
+    if not isinstance(data, np.ndarray):
+        data = np.stack([np.asarray(d) for d in data])
+    return torch.from_numpy(data)
+
+class NullSink(object):
+    # accepts and ignores any call, used in place of an unreachable visdom server
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+def connect_visdom(port):
+    try:
+        import visdom
+        vis = visdom.Visdom(port=port, raise_exceptions=True)
+        if vis.check_connection():
+            return vis
+        print('Could not connect to visdom on port %d, visualization is disabled' % port)
+    except Exception as e:
+        print('visdom is not available (%s), visualization is disabled' % e)
+    return NullSink()
+
 def set_mask(p1,p2,p3,i, output_size):
     # mask = torch.zeros(3, output_size, output_size)
     # mask[:, p1[i,1]:p1[i,1] + p1[i,3], p1[i,0]:p1[i,0] + p1[i,2]] = 1
@@ -0,0 +1,191 @@
+import os
+import glob
+import json
+import time
+import threading
+from collections import deque, OrderedDict
+import numpy as np
+
+
+class NullStage(object):
+    # returned by Profiler.stage when profiling is off, so disabled stages cost one call
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage(object):
+    __slots__ = ['profiler', 'name', 'cat', 'start']
+
+    def __init__(self, profiler, name, cat):
+        self.profiler = profiler
+        self.name = name
+        self.cat = cat
+
+    def __enter__(self):
+        self.profiler.sync()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.sync()
+        self.profiler.record(self.name, self.start, time.time() - self.start, self.cat)
+        return False
+
+
+def get_rss_mb():
+    # resident set size of this process (peak RSS where /proc is not available)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+    except (IOError, OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Profiler():
+    # Per-stage wall time, host memory (RSS) and loader queue wait of the training loop.
+    # Every process (main, loader workers) streams Chrome trace events to its own file in
+    # profile_dir; close() merges them into timeline.json (chrome://tracing, ui.perfetto.dev).
+    # Rolling percentiles of the main process stages are kept over the last profile_window calls.
+    def __init__(self):
+        self.enabled = False
+        self.trace_file = None
+
+    def initialize(self, opts):
+        self.enabled = bool(opts.profile)
+        if not self.enabled:
+            return
+        self.profile_dir = opts.profile_dir
+        self.window = opts.profile_window
+        self.use_cuda = False
+        if opts.use_gpu:
+            import torch
+            self.use_cuda = torch.cuda.is_available()
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        for trace_path in glob.glob(os.path.join(self.profile_dir, 'trace_*.json')):
+            os.remove(trace_path)
+        self.durations = OrderedDict()
+        self.lock = threading.Lock()
+        self.open_trace()
+
+    def open_trace(self):
+        # JSON array format, left unterminated so every event line is valid once written
+        self.pid = os.getpid()
+        trace_path = os.path.join(self.profile_dir, 'trace_%d.json' % self.pid)
+        self.trace_file = open(trace_path, 'w', 1)
+        self.trace_file.write('[\n')
+
+    def on_fork(self):
+        # called in loader workers: events go to a per-process file, flushed per line
+        if self.enabled and self.pid != os.getpid():
+            self.durations = OrderedDict()
+            self.lock = threading.Lock()
+            self.open_trace()
+
+    def stage(self, name, cat='stage'):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name, cat)
+
+    def iterate(self, iterable, name='loader_wait'):
+        # time spent waiting for each item, i.e. for the loader workers' queue
+        if not self.enabled:
+            return iterable
+        return self.iterate_timed(iterable, name)
+
+    def iterate_timed(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, start, time.time() - start, 'wait')
+            yield item
+
+    def sync(self):
+        # CUDA kernels run asynchronously; stage boundaries wait for them while profiling
+        if self.use_cuda:
+            import torch
+            torch.cuda.synchronize()
+
+    def record(self, name, start, duration, cat='stage'):
+        rss = get_rss_mb()
+        tid = threading.current_thread().ident
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+                 'pid': self.pid, 'tid': tid, 'args': {'rss_mb': round(rss, 1)}}
+        counter = {'name': 'rss_mb', 'ph': 'C', 'ts': (start + duration) * 1e6, 'pid': self.pid,
+                   'args': {'rss_mb': round(rss, 1)}}
+        with self.lock:
+            if name not in self.durations:
+                self.durations[name] = deque(maxlen=self.window)
+            self.durations[name].append(duration)
+            self.trace_file.write(json.dumps(event) + ',\n' + json.dumps(counter) + ',\n')
+
+    def percentiles(self):
+        # {stage: {'count', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms'}} over the rolling window
+        stats = OrderedDict()
+        if not self.enabled:
+            return stats
+        with self.lock:
+            durations = [(name, np.array(values) * 1000.0) for name, values in self.durations.items()]
+        for name, values in durations:
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            stats[name] = {'count': len(values), 'mean_ms': float(values.mean()),
+                           'p50_ms': float(p50), 'p90_ms': float(p90), 'p99_ms': float(p99)}
+        return stats
+
+    def log_scalars(self, logger, step):
+        # feeds Logger.scalar_summary with the rolling percentiles and the current RSS
+        for name, stat in self.percentiles().items():
+            for key in ['p50_ms', 'p90_ms', 'p99_ms']:
+                logger.scalar_summary('profile/%s/%s' % (name, key), stat[key], step)
+        if self.enabled:
+            logger.scalar_summary('profile/rss_mb', get_rss_mb(), step)
+
+    def print_summary(self):
+        stats = self.percentiles()
+        if not stats:
+            return
+        print('%-24s %8s %10s %10s %10s %10s' % ('stage', 'count', 'mean(ms)', 'p50(ms)', 'p90(ms)', 'p99(ms)'))
+        for name, stat in stats.items():
+            print('%-24s %8d %10.2f %10.2f %10.2f %10.2f' % (name, stat['count'], stat['mean_ms'],
+                                                              stat['p50_ms'], stat['p90_ms'], stat['p99_ms']))
+
+    def close(self):
+        # merge the per-process traces into profile_dir/timeline.json
+        if not self.enabled or self.trace_file is None:
+            return
+        self.trace_file.close()
+        self.trace_file = None
+        events = []
+        for trace_path in sorted(glob.glob(os.path.join(self.profile_dir, 'trace_*.json'))):
+            with open(trace_path) as f:
+                for line in f:
+                    line = line.strip().rstrip(',')
+                    if line.startswith('{'):
+                        events.append(json.loads(line))
+        with open(os.path.join(self.profile_dir, 'timeline.json'), 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        with open(os.path.join(self.profile_dir, 'percentiles.json'), 'w') as f:
+            json.dump(self.percentiles(), f, indent=2)
+
+    def __getstate__(self):
+        # loader workers started with spawn reopen their own trace file in on_fork
+        state = self.__dict__.copy()
+        state['trace_file'] = None
+        state.pop('lock', None)
+        state['pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
@@ -0,0 +1,244 @@
+import os
+import copy
+import json
+import time
+import shutil
+import socket
+import tempfile
+import multiprocessing
+import numpy as np
+import torch
+
+
+NODE_DIR = '/sys/devices/system/node'
+
+
+def parse_cpulist(text):
+    # '0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]
+    cores = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cores.extend(range(int(first), int(last) + 1))
+        else:
+            cores.append(int(part))
+    return cores
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def set_affinity(cores):
+    if hasattr(os, 'sched_setaffinity') and cores:
+        os.sched_setaffinity(0, cores)
+
+
+def numa_nodes(cores):
+    # cores of each NUMA node (from sysfs) restricted to cores; a single node if that is unknown
+    nodes = []
+    if os.path.isdir(NODE_DIR):
+        names = [name for name in os.listdir(NODE_DIR) if name.startswith('node') and name[4:].isdigit()]
+        for name in sorted(names, key=lambda name: int(name[4:])):
+            with open(os.path.join(NODE_DIR, name, 'cpulist')) as f:
+                node_cores = [core for core in parse_cpulist(f.read()) if core in cores]
+            if node_cores:
+                nodes.append(node_cores)
+    if sum(len(node) for node in nodes) != len(cores):
+        return [list(cores)]
+    return nodes
+
+
+def process_cores(opts):
+    # With several training processes on the node each one gets an equal, contiguous share of the
+    # cores ordered by NUMA node, so a process (and its loader workers) stays on one node if it can.
+    cores = available_cores()
+    cores = [core for node in numa_nodes(cores) for core in node]
+    nproc = int(os.environ.get('LOCAL_WORLD_SIZE', opts.nproc_per_node)) if opts.distributed else 1
+    local_rank = getattr(opts, 'local_rank', 0)
+    if nproc > 1 and len(cores) >= nproc:
+        per_proc = len(cores) // nproc
+        cores = cores[local_rank * per_proc:(local_rank + 1) * per_proc]
+    return cores
+
+
+def set_interop_threads(num_threads):
+    # only possible before the first inter-op parallel work of the process
+    if num_threads > 0 and torch.get_num_interop_threads() != num_threads:
+        try:
+            torch.set_num_interop_threads(num_threads)
+        except RuntimeError:
+            print('Inter-op thread pool already started, keeping %d threads' % torch.get_num_interop_threads())
+
+
+def cpu_model():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except IOError:
+        pass
+    return 'unknown cpu'
+
+
+class ResourceLayout():
+    # Splits the cores of the training process between the torch compute threads (the training
+    # process) and the loader workers (one core each), see --cpu_layout. The loader cores are the
+    # last ones of the process; with loader_cores=0 the workers share the training cores.
+    def __init__(self):
+        self.enabled = False
+        self.train_cores = []
+        self.loader_cores = []
+
+    def initialize(self, opts):
+        self.opts = opts
+        self.enabled = opts.cpu_layout != 'none'
+        if not self.enabled:
+            return
+        self.cores = process_cores(opts)
+        self.nodes = numa_nodes(self.cores)
+        set_interop_threads(opts.interop_threads)
+        if opts.cpu_layout == 'pin':
+            loader_cores = opts.loader_cores
+            if loader_cores < 0:
+                # one core per worker, but at most half of the cores
+                loader_cores = min(opts.num_workers, len(self.cores) // 2)
+            self.set_layout(loader_cores, opts.num_workers, opts.intra_threads)
+
+    def set_layout(self, loader_cores, num_workers, intra_threads=0):
+        loader_cores = max(0, min(loader_cores, len(self.cores) - 1))
+        self.train_cores = self.cores[:len(self.cores) - loader_cores]
+        self.loader_cores = self.cores[len(self.cores) - loader_cores:]
+        self.num_workers = num_workers
+        self.intra_threads = intra_threads if intra_threads > 0 else len(self.train_cores)
+
+    def apply(self, verbose=True):
+        if not self.enabled:
+            return
+        set_affinity(self.train_cores)
+        torch.set_num_threads(self.intra_threads)
+        # for OpenMP/MKL runtimes of processes started from here
+        os.environ['OMP_NUM_THREADS'] = str(self.intra_threads)
+        os.environ['MKL_NUM_THREADS'] = str(self.intra_threads)
+        self.opts.num_workers = self.num_workers
+        if verbose:
+            print('cpu layout: training on cores %s with %d intra-op / %d inter-op threads, '
+                  '%d loader workers on cores %s (%d NUMA nodes)'
+                  % (self.train_cores, self.intra_threads, torch.get_num_interop_threads(),
+                     self.num_workers, self.loader_cores or 'shared', len(self.nodes)))
+
+    def pin_worker(self, worker_id):
+        # called in the loader worker processes; image decoding (PIL) and numpy run single threaded there
+        if not self.enabled:
+            return
+        if self.loader_cores:
+            set_affinity([self.loader_cores[worker_id % len(self.loader_cores)]])
+        torch.set_num_threads(1)
+        os.environ['OMP_NUM_THREADS'] = '1'
+
+    ### auto-tuning ###
+
+    def machine_key(self):
+        return '%s|%s|%d cores' % (socket.gethostname(), cpu_model(), len(self.cores))
+
+    def config_key(self):
+        opts = self.opts
+        return '%s|o%d|c%d|b%d|%s|cache=%s' % (opts.model_structure, opts.output_size, opts.conv_dim,
+                                               opts.batch_size, opts.precision, bool(opts.use_cache))
+
+    def candidates(self):
+        # (loader cores, workers, intra-op threads); the first is the unpinned default layout
+        num_cores = len(self.cores)
+        configs = [(0, self.opts.num_workers, num_cores)]
+        loader_cores = set([0] + [k for k in [1, 2, 4, 8, 16, num_cores // 4, num_cores // 2] if 0 < k < num_cores])
+        for num_loader in sorted(loader_cores):
+            num_train = num_cores - num_loader
+            for intra in sorted(set([num_train, max(1, num_train // 2)]), reverse=True):
+                config = (num_loader, num_loader, intra)
+                if config not in configs:
+                    configs.append(config)
+        return configs
+
+    def autotune(self, dataset, train_idx):
+        # the best layout of this machine and training configuration, measured once and then
+        # read from opts.resource_file
+        path = os.path.expanduser(self.opts.resource_file)
+        results = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                results = json.load(f)
+        machine, config = self.machine_key(), self.config_key()
+        best = results.get(machine, {}).get(config)
+        if best is not None:
+            print('cpu layout: tuned on this machine (%s), %.3f sec/iter' % (path, best['sec_per_iter']))
+        else:
+            best = self.sweep(dataset, train_idx)
+            if getattr(self.opts, 'local_rank', 0) == 0:
+                results.setdefault(machine, {})[config] = best
+                if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'w') as f:
+                    json.dump(results, f, indent=2, sort_keys=True)
+        self.set_layout(best['loader_cores'], best['num_workers'], best['intra_threads'])
+
+    def sweep(self, dataset, train_idx):
+        # Trains a throwaway model for a few iterations per layout, with real batches from the
+        # loader; the RNG state is restored afterwards, so the training run does not change.
+        from data.loader import BatchLoader
+        from models.model import KeyPatchGanModel
+        from utils.checkpoint import get_rng_state, set_rng_state
+
+        rng_state = get_rng_state()
+        tmp_dir = tempfile.mkdtemp(prefix='keypatchgan_tune_')
+        opts = copy.copy(self.opts)
+        opts.distributed = False
+        opts.rank = 0
+        opts.cont_train = False
+        opts.use_visdom = False
+        opts.use_tensorboard = False
+        opts.profile = False
+        opts.sample_dir = os.path.join(tmp_dir, 'samples')
+        opts.test_dir = os.path.join(tmp_dir, 'test')
+        opts.net_dir = os.path.join(tmp_dir, 'nets')
+
+        warmup = 2
+        rng = np.random.RandomState(0)
+        num_batches = warmup + opts.autotune_iters
+        plan = {'batch_idx': rng.choice(train_idx, (num_batches, opts.batch_size)),
+                'shuff_idx': rng.choice(train_idx, (num_batches, opts.batch_size)),
+                'flips': rng.rand(num_batches) > 0.5}
+
+        model = KeyPatchGanModel()
+        model.initialize(opts)
+        print('%-12s %-8s %-8s %10s' % ('loader_cores', 'workers', 'threads', 'sec/iter'))
+        records = []
+        try:
+            for loader_cores, num_workers, intra_threads in self.candidates():
+                self.set_layout(loader_cores, num_workers, intra_threads)
+                self.apply(verbose=False)
+                opts.num_workers = num_workers
+                loader = BatchLoader()
+                loader.initialize(dataset, opts, layout=self)
+                for i, batch in enumerate(loader.epoch_batches(0, plan)):
+                    if i == warmup:
+                        start = time.time()
+                    images, shuff_images, part1, part2, part3, gt_masks, z = batch
+                    model.set_inputs_for_train(images, shuff_images, part1, part2, part3, z, gt_masks, 1e-2, 1e-2)
+                    model.train_step(i)
+                sec_per_iter = (time.time() - start) / opts.autotune_iters
+                print('%-12d %-8d %-8d %10.3f' % (loader_cores, num_workers, intra_threads, sec_per_iter))
+                records.append({'loader_cores': loader_cores, 'num_workers': num_workers,
+                                'intra_threads': intra_threads, 'sec_per_iter': sec_per_iter})
+        finally:
+            model.close()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            set_rng_state(rng_state)
+
+        best = min(records, key=lambda record: record['sec_per_iter'])
+        best = dict(best, results=records, tuned=time.strftime('%Y-%m-%d %H:%M:%S'))
+        return best
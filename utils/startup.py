@@ -0,0 +1,46 @@
+import time
+
+
+class StartupTimer():
+    # Import and initialization time per component, printed once by report() (--profile_startup).
+    # Only uses time, so it can be imported before anything heavy.
+    def __init__(self):
+        self.start = time.time()
+        self.records = []
+        self.reported = False
+
+    def stage(self, name):
+        return StartupStage(self, name)
+
+    def add(self, name, seconds):
+        self.records.append((name, seconds))
+
+    def mark(self, name):
+        # time from the start of the process (well, of this module's import) until now
+        self.add(name + ' (since start)', time.time() - self.start)
+
+    def report(self):
+        if self.reported:
+            return
+        self.reported = True
+        print('%-40s %10s' % ('startup component', 'sec'))
+        for name, seconds in self.records:
+            print('%-40s %10.3f' % (name, seconds))
+        print('%-40s %10.3f' % ('total', time.time() - self.start))
+
+
+class StartupStage(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, time.time() - self.start)
+        return False
+
+
+startup_timer = StartupTimer()
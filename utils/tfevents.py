@@ -0,0 +1,240 @@
+"""
+Minimal TensorBoard event file writer: TFRecord framing, masked CRC32C and hand-encoded
+Event/Summary protobufs, written by a background thread. No TensorFlow or protobuf needed.
+"""
+import os
+import time
+import zlib
+import struct
+import socket
+import threading
+import numpy as np
+
+from .background import BackgroundWriter
+
+try:
+    from crc32c import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+
+
+def _make_crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC32C_TABLE = _make_crc32c_table()
+
+
+def crc32c(data):
+    # Castagnoli CRC, from the crc32c package when installed
+    if _crc32c is not None:
+        return _crc32c(data)
+    crc = 0xFFFFFFFF
+    table = CRC32C_TABLE
+    for byte in bytearray(data):
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data):
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def tfrecord(data):
+    # length, masked crc of the length, data, masked crc of the data
+    header = struct.pack('<Q', len(data))
+    return header + struct.pack('<I', masked_crc32c(header)) + data + struct.pack('<I', masked_crc32c(data))
+
+
+### protobuf wire format ###
+
+def _varint(value):
+    value &= 0xFFFFFFFFFFFFFFFF
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+
+def _int_field(field, value):
+    return _key(field, 0) + _varint(int(value))
+
+
+def _double_field(field, value):
+    return _key(field, 1) + struct.pack('<d', value)
+
+
+def _float_field(field, value):
+    return _key(field, 5) + struct.pack('<f', value)
+
+
+def _bytes_field(field, value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return _key(field, 2) + _varint(len(value)) + value
+
+
+def _packed_doubles_field(field, values):
+    return _bytes_field(field, np.asarray(values, dtype='<f8').tobytes())
+
+
+def encode_event(wall_time, step, summary=None, file_version=None):
+    # tensorflow.Event: wall_time=1, step=2, file_version=3, summary=5
+    event = _double_field(1, wall_time) + _int_field(2, step)
+    if file_version is not None:
+        event += _bytes_field(3, file_version)
+    if summary is not None:
+        event += _bytes_field(5, summary)
+    return event
+
+
+def encode_summary(values):
+    # tensorflow.Summary: repeated Value value=1
+    return b''.join(_bytes_field(1, value) for value in values)
+
+
+def scalar_value(tag, value):
+    # Summary.Value: tag=1, simple_value=2
+    return _bytes_field(1, tag) + _float_field(2, float(value))
+
+
+def image_value(tag, encoded_png, height, width, channels):
+    # Summary.Value image=4 -> Summary.Image: height=1, width=2, colorspace=3, encoded_image_string=4
+    image = _int_field(1, height) + _int_field(2, width) + _int_field(3, channels) + _bytes_field(4, encoded_png)
+    return _bytes_field(1, tag) + _bytes_field(4, image)
+
+
+def histogram_value(tag, values, bins=1000):
+    # Summary.Value histo=5 -> HistogramProto: min=1, max=2, num=3, sum=4, sum_squares=5,
+    # bucket_limit=6, bucket=7 (packed doubles)
+    values = np.asarray(values, dtype=np.float64)
+    counts, bin_edges = np.histogram(values, bins=bins)
+    histo = _double_field(1, float(values.min())) + _double_field(2, float(values.max())) + \
+        _double_field(3, float(values.size)) + _double_field(4, float(values.sum())) + \
+        _double_field(5, float((values ** 2).sum())) + \
+        _packed_doubles_field(6, bin_edges[1:]) + _packed_doubles_field(7, counts)
+    return _bytes_field(1, tag) + _bytes_field(5, histo)
+
+
+### PNG ###
+
+def _png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + \
+        struct.pack('>I', zlib.crc32(chunk_type + data) & 0xFFFFFFFF)
+
+
+def _png_from_rows(rows, height, width, channels, level):
+    # rows: (H, 1 + W * C) uint8 with the (None) filter byte already in front of each row
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', ihdr) + \
+        _png_chunk(b'IDAT', zlib.compress(rows.tobytes(), level)) + _png_chunk(b'IEND', b'')
+
+
+def to_uint8(images):
+    # uint8 as is; other dtypes are scaled from their [min, max] to [0, 255] per image, like scipy's toimage
+    images = np.asarray(images)
+    if images.dtype == np.uint8:
+        return images
+    images = images.astype(np.float32)
+    axes = tuple(range(1, images.ndim))
+    low = images.min(axis=axes, keepdims=True)
+    high = images.max(axis=axes, keepdims=True)
+    scale = 255.0 / np.maximum(high - low, 1e-12)
+    return ((images - low) * scale + 0.5).astype(np.uint8)
+
+
+def encode_png(image, level=6):
+    # (H, W) or (H, W, C) uint8 array
+    return encode_png_batch(np.asarray(image)[None], level)[0]
+
+
+def encode_png_batch(images, level=6, pool=None):
+    """PNG-encode a (N, H, W[, C]) uint8 batch; the rows of all images are prepared in one numpy op
+    and zlib, which releases the GIL, runs on the thread pool when given."""
+    images = np.asarray(images)
+    if images.ndim == 3:
+        images = images[..., None]
+    num, height, width, channels = images.shape
+    rows = np.zeros((num, height, 1 + width * channels), dtype=np.uint8)
+    rows[:, :, 1:] = images.reshape(num, height, width * channels)
+    encode = lambda n: _png_from_rows(rows[n], height, width, channels, level)
+    if pool is None:
+        return [encode(n) for n in range(num)]
+    return pool.map(encode, range(num))
+
+
+class EventFileWriter(BackgroundWriter):
+    # Appends TFRecord-framed events to events.out.tfevents.<time>.<host> in log_dir.
+    # Serialized events are queued and written by a background thread that flushes the
+    # file every flush_secs (and on flush/close).
+    error_message = 'Writing event file failed'
+
+    def __init__(self, log_dir, flush_secs=10, max_queue=1000, filename_suffix=''):
+        super(EventFileWriter, self).__init__()
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        filename = 'events.out.tfevents.%010d.%s%s' % (time.time(), socket.gethostname(), filename_suffix)
+        self.path = os.path.join(log_dir, filename)
+        self.file = open(self.path, 'wb')
+        self.flush_secs = flush_secs
+        self.last_flush = time.time()
+        self.start(max_queue, idle_secs=flush_secs)
+        self.add_event(encode_event(time.time(), 0, file_version='brain.Event:2'))
+
+    def add_event(self, event):
+        self.put(event)
+
+    def add_summary(self, values, step, wall_time=None):
+        wall_time = time.time() if wall_time is None else wall_time
+        self.add_event(encode_event(wall_time, step, summary=encode_summary(values)))
+
+    def process(self, item):
+        if isinstance(item, threading.Event):
+            # flush request
+            try:
+                self.flush_file()
+            finally:
+                item.set()
+            return
+        self.file.write(tfrecord(item))
+        self.idle()
+
+    def idle(self):
+        if time.time() - self.last_flush >= self.flush_secs:
+            self.flush_file()
+
+    def flush_file(self):
+        self.file.flush()
+        self.last_flush = time.time()
+
+    def flush(self):
+        # blocks until everything queued so far is on disk
+        if self.file.closed:
+            return
+        done = threading.Event()
+        self.put(done)
+        done.wait()
+        self.check_error()
+
+    def close(self):
+        try:
+            super(EventFileWriter, self).close()
+        finally:
+            self.file.close()